@@ -0,0 +1,323 @@
+# ⚔️ 전투 규칙 + 대량 시뮬레이터
+# main.py 의 !전투 버튼과 같은 규칙을 쓴다. 디스코드/시트 없이 단독 실행 가능:
+#   python battle.py --hp 50 --n 1000000
+import argparse
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# ====== 규칙 상수 ======
+BATTLE_START_HP = 50      # 시작 체력
+ATTACK_DICE = 5           # 공격: 1D6 × 5
+DEFENSE_DICE = 1          # 방어: 1D6 × 1
+FIRST_DEFENSE_BONUS = 1   # 후공의 첫 방어에만 추가되는 주사위 수
+DICE_SIDES = 6
+MAX_ROUNDS = 1000         # 시뮬레이션 안전 상한 (실제 전투엔 없음)
+
+# ====== 상태 / 전이 ======
+PHASE_ATTACK = "attack"
+PHASE_DEFEND = "defend"
+
+ATTACK = "attack"
+DEFEND = "defend"
+FORCE_END = "force_end"
+
+# 전이 함수가 돌려주는 이벤트 (디스코드 쪽은 이것만 보고 메시지를 만든다)
+Rejected = namedtuple("Rejected", "action")
+Attacked = namedtuple("Attacked", "attacker defender rolls total")
+Defended = namedtuple("Defended", "attacker defender atk_rolls atk_total def_rolls def_total dmg_to_defender dmg_to_attacker")
+LastStrike = namedtuple("LastStrike", "player")
+NextTurn = namedtuple("NextTurn", "attacker")
+Ended = namedtuple("Ended", "winner reason")  # reason: knockout / counter / final / forced
+
+def decide_winner(hp1_val, hp2_val, p1, p2):
+    # 0 이하면 '0에 더 가까운'(값이 더 큰) 쪽이 승
+    if hp1_val <= 0 and hp2_val > 0:
+        return p2
+    elif hp2_val <= 0 and hp1_val > 0:
+        return p1
+    elif hp1_val <= 0 and hp2_val <= 0:
+        if hp1_val > hp2_val:
+            return p1
+        elif hp2_val > hp1_val:
+            return p2
+        else:
+            return None  # 무승부
+    else:
+        if hp1_val > hp2_val:
+            return p1
+        elif hp2_val > hp1_val:
+            return p2
+        else:
+            return None  # 무승부
+
+class BattleState:
+    """
+    전투 한 판의 상태. 플레이어는 0/1 인덱스로 다룬다.
+    turn 은 현재(또는 방금) 공격하는 쪽, 방어자는 1 - turn.
+    log/pending 은 전투판 표시용으로만 쓰이고 규칙에는 관여하지 않는다.
+    """
+    __slots__ = ("p1", "p2", "hp1", "hp2", "first", "turn", "phase",
+                 "last_strike", "first_defense", "round", "atk_rolls", "log", "pending")
+
+    def __init__(self, p1: str, p2: str, first: int = 0, hp: int = BATTLE_START_HP):
+        self.p1 = p1
+        self.p2 = p2
+        self.hp1 = hp
+        self.hp2 = hp
+        self.first = first            # 선공 인덱스 (후공 = 1 - first)
+        self.turn = first
+        self.phase = PHASE_ATTACK
+        self.last_strike = False      # 후공 최종반격 진행 중
+        self.first_defense = True     # 후공 첫 방어 보너스 남음
+        self.round = 0
+        self.atk_rolls = ()
+        self.log = []
+        self.pending = None
+
+    def name(self, idx: int) -> str:
+        return self.p1 if idx == 0 else self.p2
+
+    def hp(self, idx: int) -> int:
+        return self.hp1 if idx == 0 else self.hp2
+
+    def _hit(self, idx: int, dmg: int):
+        if idx == 0:
+            self.hp1 -= dmg
+        else:
+            self.hp2 -= dmg
+
+    def copy(self) -> "BattleState":
+        st = BattleState.__new__(BattleState)
+        st.p1, st.p2, st.hp1, st.hp2 = self.p1, self.p2, self.hp1, self.hp2
+        st.first, st.turn, st.phase = self.first, self.turn, self.phase
+        st.last_strike, st.first_defense, st.round = self.last_strike, self.first_defense, self.round
+        st.atk_rolls, st.log, st.pending = self.atk_rolls, list(self.log), self.pending
+        return st
+
+    def winner(self):
+        return decide_winner(self.hp1, self.hp2, self.p1, self.p2)
+
+    def to_dict(self) -> dict:
+        return {
+            "v": 2, "p": [self.p1, self.p2], "hp": [self.hp1, self.hp2], "f": self.first, "t": self.turn,
+            "ph": self.phase, "ls": self.last_strike, "fd": self.first_defense, "r": self.round,
+            "ar": list(self.atk_rolls), "log": self.log, "pl": self.pending,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "BattleState":
+        if "플레이어1" in d:  # 이전 버전(한글 키 dict) 저장분
+            p1, p2 = d["플레이어1"], d["플레이어2"]
+            st = cls(p1, p2, 0 if d["선공"] == p1 else 1)
+            st.hp1, st.hp2 = d["체력"][p1], d["체력"][p2]
+            st.turn = 0 if d["턴"] == p1 else 1
+            st.phase = PHASE_ATTACK if d["단계"] == "공격" else PHASE_DEFEND
+            st.last_strike = d.get("최종반격", False)
+            st.first_defense = d.get("첫방어", True)
+            st.round = d.get("라운드", 0)
+            st.atk_rolls = tuple((d.get("최근공격") or {}).get("주사위", []))
+            st.log = list(d.get("기록", []))
+            st.pending = d.get("최근결과")
+            return st
+        st = cls(d["p"][0], d["p"][1], d["f"])
+        st.hp1, st.hp2 = d["hp"]
+        st.turn, st.phase = d["t"], d["ph"]
+        st.last_strike, st.first_defense, st.round = d["ls"], d["fd"], d["r"]
+        st.atk_rolls = tuple(d["ar"])
+        st.log = list(d.get("log", []))
+        st.pending = d.get("pl")
+        return st
+
+def transition(state: BattleState, action: str, roll):
+    """
+    부작용 없는 전이: state 는 그대로 두고 (새 상태, 이벤트 목록)을 돌려준다.
+    roll(k) 는 1D6 k개의 목록을 돌려주는 함수 (테스트/재생 시 고정 주사위 주입 가능).
+    """
+    if action == FORCE_END:
+        return state, [Ended(state.winner(), "forced")]
+
+    if action == ATTACK:
+        if state.phase != PHASE_ATTACK:
+            return state, [Rejected(action)]
+        st = state.copy()
+        st.atk_rolls = tuple(roll(ATTACK_DICE))
+        st.round += 1
+        st.phase = PHASE_DEFEND
+        return st, [Attacked(st.name(st.turn), st.name(1 - st.turn), st.atk_rolls, sum(st.atk_rolls))]
+
+    if action != DEFEND or state.phase != PHASE_DEFEND:
+        return state, [Rejected(action)]
+
+    st = state.copy()
+    att, dfn = st.turn, 1 - st.turn
+    atk_total = sum(st.atk_rolls)
+    def_rolls = list(roll(DEFENSE_DICE))
+    if dfn != st.first and st.first_defense:  # 후공 첫 방어 시 주사위 추가
+        def_rolls += roll(FIRST_DEFENSE_BONUS)
+        st.first_defense = False
+    def_total = sum(def_rolls)
+
+    dmg_to_defender = max(atk_total - def_total, 0)
+    dmg_to_attacker = max(def_total - atk_total, 0)
+    st._hit(dfn, dmg_to_defender)
+    st._hit(att, dmg_to_attacker)
+    events = [Defended(st.name(att), st.name(dfn), st.atk_rolls, atk_total,
+                       tuple(def_rolls), def_total, dmg_to_defender, dmg_to_attacker)]
+
+    # A) 방어자가 맞아서 0 이하 → 후공에게만 최종 반격 1회, 아니면 종료
+    if dmg_to_defender > 0 and st.hp(dfn) <= 0:
+        if not st.last_strike and dfn != st.first:
+            st.last_strike = True
+            st.turn, st.phase = dfn, PHASE_ATTACK
+            events.append(LastStrike(st.name(dfn)))
+        else:
+            events.append(Ended(st.winner(), "knockout"))
+        return st, events
+    # B) 반격으로 공격자가 0 이하
+    if dmg_to_attacker > 0 and st.hp(att) <= 0:
+        events.append(Ended(st.winner(), "counter"))
+        return st, events
+    # C) 최종 반격이 끝남
+    if st.last_strike:
+        events.append(Ended(st.winner(), "final"))
+        return st, events
+
+    # 일반 턴 전환: 다음은 방어자의 공격
+    st.turn, st.phase = dfn, PHASE_ATTACK
+    events.append(NextTurn(st.name(dfn)))
+    return st, events
+
+_FACES = range(1, DICE_SIDES + 1)
+
+def dice_roller(rng: random.Random | None = None):
+    choices = (rng or random).choices
+    return lambda k: choices(_FACES, k=k) if k > 0 else []
+
+# ====== 대량 시뮬레이션 ======
+def _roll_sum(rng, n: int, dice: int):
+    if dice <= 0:
+        return np.zeros(n, dtype=np.int16)
+    return rng.integers(1, DICE_SIDES + 1, size=(n, dice), dtype=np.int8).sum(axis=1, dtype=np.int16)
+
+def simulate(n: int, hp: int = BATTLE_START_HP, seed=None) -> dict:
+    """
+    전투 n 판을 배열 연산으로 한꺼번에 굴린다. 선공(F)/후공(S) 기준으로 집계.
+    - 공격 > 방어: 방어자 피해, 방어 > 공격: 공격자 반격 피해, 같으면 완전 방어
+    - 방어자가 0 이하가 되면 후공에게만 최종반격 1회, 그 뒤 한 번 더 방어가 끝나면 종료
+    - 반격으로 공격자가 0 이하가 되면 즉시 종료
+    - 승패는 decide_winner 와 같다 (체력이 더 큰 쪽, 같으면 무승부)
+    반환: 승률/무승부율/라운드 분포 등 dict
+    """
+    rng = np.random.default_rng(seed)
+    hp_f = np.full(n, hp, dtype=np.int32)
+    hp_s = np.full(n, hp, dtype=np.int32)
+    atk_is_f = np.ones(n, dtype=bool)        # 선공이 먼저 공격
+    first_def = np.ones(n, dtype=bool)       # 후공 첫 방어 보너스 남음
+    last_strike = np.zeros(n, dtype=bool)    # 최종반격 진행 중
+    rounds = np.zeros(n, dtype=np.int32)
+    active = np.arange(n)
+
+    for _ in range(MAX_ROUNDS):
+        if active.size == 0:
+            break
+        m = active.size
+        a_f = atk_is_f[active]
+        atk = _roll_sum(rng, m, ATTACK_DICE)
+        dfn = _roll_sum(rng, m, DEFENSE_DICE)
+
+        # 후공(S)이 방어하는 첫 번째 방어에 주사위 추가
+        bonus = a_f & first_def[active]
+        if bonus.any():
+            dfn = dfn + np.where(bonus, _roll_sum(rng, m, FIRST_DEFENSE_BONUS), 0).astype(np.int16)
+        first_def[active] &= ~bonus
+
+        dmg_def = np.clip(atk - dfn, 0, None).astype(np.int32)
+        dmg_att = np.clip(dfn - atk, 0, None).astype(np.int32)
+        hp_f[active] -= np.where(a_f, dmg_att, dmg_def)
+        hp_s[active] -= np.where(a_f, dmg_def, dmg_att)
+        rounds[active] += 1
+
+        def_hp = np.where(a_f, hp_s[active], hp_f[active])
+        att_hp = np.where(a_f, hp_f[active], hp_s[active])
+        was_last = last_strike[active]
+
+        down = (dmg_def > 0) & (def_hp <= 0)
+        grant = down & ~was_last & a_f                # 방어자가 후공일 때만 최종반격
+        end = (down & ~grant) | (~down & (dmg_att > 0) & (att_hp <= 0)) | (~down & was_last)
+
+        last_strike[active[grant]] = True
+        atk_is_f[active] = ~a_f                       # 다음은 방어자가 공격
+        active = active[~end]
+
+    return _report(n, hp, hp_f.astype(np.int64) - hp_s.astype(np.int64), rounds, int(active.size))
+
+def simulate_engine(n: int, hp: int = BATTLE_START_HP, seed=None) -> dict:
+    """
+    transition() 을 한 판씩 그대로 돌리는 기준 구현 (버튼과 같은 코드 경로).
+    simulate() 와 결과 분포가 같아야 한다 — 규칙을 바꾸면 둘 다 확인.
+    """
+    roll = dice_roller(random.Random(seed))
+    diff = np.zeros(n, dtype=np.int64)
+    rounds = np.zeros(n, dtype=np.int32)
+    unfinished = 0
+    for i in range(n):
+        st = BattleState("F", "S", 0, hp)
+        for _ in range(MAX_ROUNDS):
+            st, _ = transition(st, ATTACK, roll)
+            st, events = transition(st, DEFEND, roll)
+            if isinstance(events[-1], Ended):
+                break
+        else:
+            unfinished += 1
+        diff[i] = st.hp1 - st.hp2
+        rounds[i] = st.round
+    return _report(n, hp, diff, rounds, unfinished)
+
+def _report(n: int, hp: int, diff, rounds, unfinished: int) -> dict:
+    f_win = int((diff > 0).sum())
+    s_win = int((diff < 0).sum())
+    draw = n - f_win - s_win
+    pct = np.percentile(rounds, [50, 90, 99]) if n else [0, 0, 0]
+    hist_vals, hist_counts = np.unique(rounds, return_counts=True)
+    return {
+        "n": n,
+        "hp": hp,
+        "first_win": f_win / n,
+        "second_win": s_win / n,
+        "draw": draw / n,
+        "first_mover_edge": (f_win - s_win) / n,
+        "rounds_mean": float(rounds.mean()) if n else 0.0,
+        "rounds_p50": int(pct[0]),
+        "rounds_p90": int(pct[1]),
+        "rounds_p99": int(pct[2]),
+        "rounds_hist": dict(zip(hist_vals.tolist(), hist_counts.tolist())),
+        "unfinished": unfinished,
+    }
+
+def format_report(r: dict) -> str:
+    top = sorted(r["rounds_hist"].items(), key=lambda kv: -kv[1])[:5]
+    hist = ", ".join(f"{k}R {v / r['n']:.1%}" for k, v in sorted(top))
+    return (
+        f"시작 체력 {r['hp']}, {r['n']:,}판 시뮬레이션\n"
+        f"선공 승 **{r['first_win']:.2%}** / 후공 승 **{r['second_win']:.2%}** / 무승부 **{r['draw']:.2%}**\n"
+        f"선공 우위: {r['first_mover_edge']:+.2%}\n"
+        f"라운드: 평균 {r['rounds_mean']:.2f}, 중앙값 {r['rounds_p50']}, 90% {r['rounds_p90']}, 99% {r['rounds_p99']}\n"
+        f"주요 라운드 분포: {hist}"
+    )
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="전투 규칙 몬테카를로 시뮬레이션")
+    ap.add_argument("--hp", type=int, default=BATTLE_START_HP)
+    ap.add_argument("--n", type=int, default=1_000_000)
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--engine", choices=["numpy", "state"], default="numpy",
+                    help="numpy: 배열 시뮬레이터, state: transition() 한 판씩 (기준 구현)")
+    args = ap.parse_args()
+    t0 = time.perf_counter()
+    run = simulate if args.engine == "numpy" else simulate_engine
+    report = run(args.n, args.hp, args.seed)
+    print(format_report(report))
+    print(f"({time.perf_counter() - t0:.2f}s)")
@@ -0,0 +1,229 @@
+# ⏱️ 명령별 벤치마크: 메모리 gspread 대역(fake_gspread) 위에서 명령을 직접 실행한다.
+# 각 경우마다 새 시트로 바꾸고 캐시를 비운 뒤
+#   - 첫 실행(cold) / 이어지는 실행(warm) 의 API 호출 수
+#   - warm 실행 시간 중앙값
+#   - tracemalloc 으로 잰 한 번 실행의 최대 할당량
+# 을 출력하고, baseline.json 보다 호출 수가 늘면 종료 코드 1 로 실패한다.
+#
+#   python bench/bench_commands.py                 # 측정 + 회귀 검사
+#   python bench/bench_commands.py --latency 0.05  # 호출당 50ms 지연을 넣고 측정
+#   python bench/bench_commands.py --failure-rate 0.1 --quota 300  # 503/429 를 섞어 재시도 경로까지 측정
+#   python bench/bench_commands.py --update-baseline
+#   python bench/bench_commands.py --self-test      # 회귀 판정 자체 점검
+#
+# 모든 호출은 main.QuotaHTTPClient 를 거치므로 주입한 오류는 실제와 같이 재시도된다.
+# 호출 수는 성공한 요청만 세고, 재시도로 넘긴 오류(fail)와 재시도 끝에 실패한 실행(err)은 따로 보고한다.
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_gspread
+
+SHEET_KEY = "bench-sheet"
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+
+def make_book(backend, hp_rows: int = 60, roster_rows: int = 60):
+    """체력값: 2행 G/I 합계, B6 부터 이름·D열 체력. 명단: B3 부터 이름·F열 물품."""
+    hp = [[], ["", "", "", "", "", "", "100", "", "200"], [], [], []]
+    hp += [["", f"캐릭터{i}", "", str(50 + i % 50)] for i in range(hp_rows)]
+    roster = [[], []]
+    roster += [["", f"캐릭터{i}", "", "", "", "에너지바 2개, 붕대 99개"] for i in range(roster_rows)]
+    return fake_gspread.FakeSpreadsheet(SHEET_KEY, {"체력값": hp, "명단": roster, "연결 확인": []}, backend)
+
+# ====== 벤치 대상 ======
+# (이름, 체력값 행 수, 명령, 위치 인자, 키워드 인자)
+CASES = [
+    ("구매", 60, "구매", ("캐릭터1",), {"아이템문구": "붕대, 에너지바 2개"}),
+    ("사용", 60, "사용", ("캐릭터2",), {"아이템문구": "붕대"}),
+    ("추가x1", 60, "추가", ("캐릭터0", "3"), {}),
+    ("추가x10", 60, "추가", tuple(f"캐릭터{i}" for i in range(10)) + ("3",), {}),
+    ("추가x50", 60, "추가", tuple(f"캐릭터{i}" for i in range(50)) + ("3",), {}),
+    ("일괄", 60, "일괄", (), {"스크립트": "\n".join(
+        [f"추가 캐릭터{i} 2" for i in range(5)] + [f"차감 캐릭터{i} 1" for i in range(5, 8)]
+        + ["구매 캐릭터1 붕대, 에너지바 2개", "사용 캐릭터2 붕대"]
+    )}),
+    ("전체10k", 10_000, "전체", ("+1",), {}),
+    ("추첨", 60, "추첨", ("3",), {}),
+    ("추첨D20k", 20_000, "추첨", ("100", "D"), {}),
+]
+
+class BenchContext:
+    """commands.Context 대신 쓰는 최소 객체. 보낸 메시지만 모아 둔다."""
+
+    def __init__(self):
+        self.sent = []
+        self.author = types.SimpleNamespace(id=0, display_name="bench")
+        self.channel = types.SimpleNamespace(id=0)
+        self.guild = None
+        self.command = None
+        self.message = types.SimpleNamespace(content="")
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+        return types.SimpleNamespace(id=0, edit=self._edit)
+
+    async def _edit(self, **kwargs):
+        pass
+
+def reset_state(main, client, backend, hp_rows: int):
+    """새 시트로 바꾸고 봇이 들고 있는 시트 관련 캐시를 모두 비운다."""
+    client.books[SHEET_KEY] = make_book(backend, hp_rows=hp_rows, roster_rows=max(60, hp_rows // 100))
+    main.sheet_handles.invalidate()
+    main.name_index.invalidate()
+    main.sheet_replicas.get().mark_stale()
+    backend.reset_calls()
+
+async def run_case(main, client, backend, case, repeat: int) -> dict:
+    name, hp_rows, cmd, args, kwargs = case
+    callback = main.bot.get_command(cmd).callback
+
+    failed_runs = 0
+
+    async def once():
+        nonlocal failed_runs
+        ctx = BenchContext()
+        before = backend.total_failures()
+        await callback(ctx, *args, **kwargs)
+        errors = [m for m in ctx.sent if m and m.startswith(("❌", "⚠️"))]
+        if errors:
+            if backend.total_failures() == before:  # 주입한 오류 없이 실패했으면 벤치가 아니라 코드 문제
+                raise RuntimeError(f"{name}: {errors[0]}")
+            failed_runs += 1
+
+    reset_state(main, client, backend, hp_rows)
+    await once()
+    cold = dict(backend.calls)
+    failures = backend.total_failures()
+
+    backend.reset_calls()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        await once()
+        times.append(time.perf_counter() - t0)
+    warm = backend.total_calls() / repeat
+    failures += backend.total_failures()
+
+    tracemalloc.start()
+    await once()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "cold_calls": sum(cold.values()),
+        "cold_detail": cold,
+        "warm_calls": warm,
+        "median_ms": statistics.median(times) * 1000,
+        "peak_kib": peak / 1024,
+        "failures": failures,
+        "failed_runs": failed_runs,
+    }
+
+def check_regressions(results: list[dict], baseline: dict) -> list[str]:
+    problems = []
+    for r in results:
+        base = baseline.get(r["name"])
+        if base is None:
+            continue
+        for key in ("cold_calls", "warm_calls"):
+            if r[key] > base[key]:
+                problems.append(f"{r['name']}: {key} {base[key]} → {r[key]:g}")
+    return problems
+
+def self_test() -> int:
+    """check_regressions 가 알려진 회귀는 잡고, 같거나 줄어든 값과 baseline 에 없는 경우는 넘기는지 확인."""
+    baseline = {"a": {"cold_calls": 3, "warm_calls": 1}, "b": {"cold_calls": 5, "warm_calls": 2}}
+    results = [
+        {"name": "a", "cold_calls": 4, "warm_calls": 1},
+        {"name": "b", "cold_calls": 5, "warm_calls": 1.5},
+        {"name": "new", "cold_calls": 99, "warm_calls": 99},
+    ]
+    problems = check_regressions(results, baseline)
+    expected = ["a: cold_calls 3 → 4"]
+    if problems != expected:
+        print(f"❌ check_regressions 자체 점검 실패: {problems!r} (기대값 {expected!r})")
+        return 1
+    print("✅ check_regressions 자체 점검 통과")
+    return 0
+
+def main_():
+    parser = argparse.ArgumentParser(description="메모리 시트 위에서 명령별 API 호출 수/시간/할당량 측정")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="API 호출당 지연(초)")
+    parser.add_argument("--quota", type=int, default=0, help="분당 요청 한도 (넘으면 429, 0 이면 제한 없음)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="요청이 503 으로 실패할 확률")
+    parser.add_argument("--only", nargs="*", help="측정할 경우 이름")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--self-test", action="store_true", help="회귀 판정 로직만 점검하고 종료")
+    opts = parser.parse_args()
+
+    if opts.self_test:
+        return self_test()
+
+    backend = fake_gspread.FakeBackend(latency=opts.latency, quota_per_minute=opts.quota, failure_rate=opts.failure_rate)
+    client = fake_gspread.FakeClient({SHEET_KEY: make_book(backend)})
+    fake_gspread.install(client, SHEET_KEY)
+    tmp = tempfile.mkdtemp(prefix="haewoo-bench-")
+    os.environ["BATTLE_STORE_PATH"] = os.path.join(tmp, "battles.sqlite3")
+    os.environ["PROFILE_DIR"] = os.path.join(tmp, "profiles")
+    os.environ["AUDIT_LOG_PATH"] = os.path.join(tmp, "audit_log.jsonl")  # 감사 로그 시트 반영은 백그라운드라 측정에서 빠짐
+    # 봇 쪽 토큰 버킷은 서버 한도와 같게 (한도가 없으면 사실상 끈다)
+    os.environ["SHEETS_QUOTA_PER_MIN"] = str(opts.quota or 1_000_000)
+    import main
+    backend.http = main.QuotaHTTPClient(None, session=fake_gspread.FakeSession(backend))
+    main.sheets.connect()  # 봇 시작 시에는 백그라운드에서 하는 인증을 바로 수행
+
+    cases = [c for c in CASES if not opts.only or c[0] in opts.only]
+
+    async def run_all():
+        return [await run_case(main, client, backend, c, opts.repeat) for c in cases]
+
+    results = asyncio.run(run_all())
+
+    print(f"{'case':<10} {'cold':>5} {'warm':>6} {'median ms':>10} {'peak KiB':>9} {'fail':>5} {'err':>4}  cold calls")
+    for r in results:
+        detail = ", ".join(f"{k}={v}" for k, v in sorted(r["cold_detail"].items()))
+        print(
+            f"{r['name']:<10} {r['cold_calls']:>5} {r['warm_calls']:>6g} {r['median_ms']:>10.2f} {r['peak_kib']:>9.1f}"
+            f" {r['failures']:>5} {r['failed_runs']:>4}  {detail}"
+        )
+
+    if opts.update_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update({r["name"]: {"cold_calls": r["cold_calls"], "warm_calls": r["warm_calls"]} for r in results})
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"📝 baseline 갱신: {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("⚠️ baseline.json 이 없습니다. --update-baseline 으로 먼저 만드세요.")
+        return 0
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        problems = check_regressions(results, json.load(f))
+    if problems:
+        print("❌ API 호출 수 회귀:")
+        for p in problems:
+            print(f"  - {p}")
+        return 1
+    print("✅ API 호출 수 회귀 없음")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_())
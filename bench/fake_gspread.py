@@ -0,0 +1,302 @@
+# 🧪 메모리 안에서 동작하는 gspread 대역 (벤치마크/로컬 실험용)
+# main.py 가 쓰는 Worksheet / Spreadsheet / Client 메서드만 흉내 낸다.
+# - 성공한 호출은 FakeBackend.calls 에 (메서드 이름) 단위로 집계된다 → 명령별 API 호출 수 측정
+# - latency: 호출마다 지연(초), quota_per_minute: 초과 시 429, failure_rate: 무작위 503
+#   주입한 오류는 FakeBackend.failures 에 (메서드 이름, 상태 코드) 단위로 따로 센다
+# - FakeBackend.http 에 main.QuotaHTTPClient(세션은 FakeSession) 를 넣으면 모든 호출이 그 클라이언트를 거쳐
+#   실제와 같은 쿼터 대기/재시도를 받는다. 비워 두면 오류가 호출자에게 바로 올라간다.
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+import gspread
+import requests
+from gspread.utils import a1_to_rowcol
+
+class FakeBackend:
+    def __init__(self, latency: float = 0.0, quota_per_minute: int = 0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.quota_per_minute = quota_per_minute  # 0 이면 제한 없음
+        self.failure_rate = failure_rate
+        self.calls = collections.Counter()
+        self.failures = collections.Counter()
+        self.http = None
+        self._rng = random.Random(seed)
+        self._window = collections.deque()
+        self._lock = threading.Lock()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+            self.failures.clear()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def total_failures(self) -> int:
+        with self._lock:
+            return sum(self.failures.values())
+
+    def hit(self, method: str):
+        """API 요청 한 번. http 가 있으면 그 클라이언트(재시도/쿼터 대기 포함)를 거친다."""
+        if self.http is not None:
+            verb = "POST" if method in WRITE_METHODS else "GET"
+            suffix = ":append" if method == "append_rows" else ""
+            self.http.request(verb, f"{FAKE_ENDPOINT}/{method}{suffix}")
+            return
+        status = self.respond(method)
+        if status != 200:
+            raise _api_error(status, STATUS_REASONS[status])
+
+    def respond(self, method: str) -> int:
+        """서버 쪽 처리. 쿼터/장애 주입 → 상태 코드, 성공이면 집계 후 지연."""
+        with self._lock:
+            now = time.monotonic()
+            status = 200
+            if self.quota_per_minute:
+                while self._window and now - self._window[0] >= 60:
+                    self._window.popleft()
+                if len(self._window) >= self.quota_per_minute:
+                    status = 429
+                else:
+                    self._window.append(now)
+            if status == 200 and self.failure_rate and self._rng.random() < self.failure_rate:
+                status = 503
+            if status == 200:
+                self.calls[method] += 1
+            else:
+                self.failures[(method, status)] += 1
+        if status == 200 and self.latency:
+            time.sleep(self.latency)
+        return status
+
+FAKE_ENDPOINT = "https://sheets.googleapis.com/v4/spreadsheets/fake/values"
+WRITE_METHODS = {
+    "update_cell", "update_acell", "update", "batch_update", "append_rows",
+    "batch_update_spreadsheet", "values_batch_update",
+}
+STATUS_REASONS = {429: "RESOURCE_EXHAUSTED", 503: "UNAVAILABLE"}
+
+class FakeSession(requests.Session):
+    """QuotaHTTPClient 아래에 끼우는 세션. 네트워크 대신 backend.respond 의 상태 코드로 응답한다."""
+
+    def __init__(self, backend: FakeBackend):
+        super().__init__()
+        self.backend = backend
+
+    def request(self, method, url, **kwargs):
+        status = self.backend.respond(url.rsplit("/", 1)[-1].split(":")[0])
+        if status == 200:
+            resp = requests.Response()
+            resp.status_code = 200
+            resp._content = b"{}"
+            return resp
+        return _error_response(status, STATUS_REASONS[status])
+
+def _error_response(status: int, reason: str) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps({"error": {"code": status, "message": reason, "status": reason}}).encode()
+    return resp
+
+def _api_error(status: int, reason: str) -> gspread.exceptions.APIError:
+    return gspread.exceptions.APIError(_error_response(status, reason))
+
+class FakeCell:
+    __slots__ = ("row", "col", "value")
+
+    def __init__(self, row: int, col: int, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+class FakeWorksheet:
+    def __init__(self, book: "FakeSpreadsheet", title: str, rows=None, sheet_id: int = 0):
+        self.spreadsheet = book
+        self.title = title
+        self.id = sheet_id
+        self._rows = [[str(v) for v in r] for r in (rows or [])]
+
+    @property
+    def spreadsheet_id(self) -> str:
+        return self.spreadsheet.id
+
+    @property
+    def row_count(self) -> int:
+        return len(self._rows)
+
+    # --- 셀 저장소 ---
+    def _get(self, r: int, c: int) -> str:
+        if r <= len(self._rows) and c <= len(self._rows[r - 1]):
+            return self._rows[r - 1][c - 1]
+        return ""
+
+    def _set(self, r: int, c: int, value):
+        while len(self._rows) < r:
+            self._rows.append([])
+        row = self._rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = "" if value is None else str(value)
+
+    def _bounds(self, a1: str):
+        """'B6:D' / 'D6' / 'B1:F' → (r1, c1, r2, c2). 열만 적은 끝은 데이터 마지막 행까지."""
+        a1 = a1.rsplit("!", 1)[-1]
+        start, _, end = a1.partition(":")
+        r1, c1 = a1_to_rowcol(start)
+        if not end:
+            return r1, c1, r1, c1
+        if end.isalpha():
+            return r1, c1, max(len(self._rows), r1 - 1), a1_to_rowcol(end + "1")[1]
+        r2, c2 = a1_to_rowcol(end)
+        return r1, c1, r2, c2
+
+    def _values(self, a1: str) -> list[list[str]]:
+        # 실제 API 처럼 행 끝과 범위 끝의 빈 칸은 잘라서 돌려준다
+        r1, c1, r2, c2 = self._bounds(a1)
+        out = []
+        for r in range(r1, r2 + 1):
+            row = [self._get(r, c) for c in range(c1, c2 + 1)]
+            while row and row[-1] == "":
+                row.pop()
+            out.append(row)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def _write(self, a1: str, values):
+        r1, c1, _, _ = self._bounds(a1)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self._set(r1 + i, c1 + j, v)
+
+    # --- gspread.Worksheet 흉내 ---
+    def col_values(self, col: int, **kwargs) -> list[str]:
+        self.spreadsheet.backend.hit("col_values")
+        out = [self._get(r, col) for r in range(1, len(self._rows) + 1)]
+        while out and out[-1] == "":
+            out.pop()
+        return out
+
+    def cell(self, row: int, col: int, **kwargs) -> FakeCell:
+        self.spreadsheet.backend.hit("cell")
+        return FakeCell(row, col, self._get(row, col) or None)
+
+    def acell(self, label: str, **kwargs) -> FakeCell:
+        self.spreadsheet.backend.hit("acell")
+        r, c = a1_to_rowcol(label)
+        return FakeCell(r, c, self._get(r, c) or None)
+
+    def get(self, range_name: str | None = None, **kwargs) -> list[list[str]]:
+        self.spreadsheet.backend.hit("get")
+        return self._values(range_name or "A1:ZZ")
+
+    def batch_get(self, ranges, **kwargs) -> list[list[list[str]]]:
+        self.spreadsheet.backend.hit("batch_get")
+        return [self._values(a1) for a1 in ranges]
+
+    def update_cell(self, row: int, col: int, value):
+        self.spreadsheet.backend.hit("update_cell")
+        self._set(row, col, value)
+
+    def update_acell(self, label: str, value):
+        self.spreadsheet.backend.hit("update_acell")
+        r, c = a1_to_rowcol(label)
+        self._set(r, c, value)
+
+    def update(self, range_name, values=None, **kwargs):
+        self.spreadsheet.backend.hit("update")
+        if values is None:  # 옛 호출 순서 update(values, range_name)
+            range_name, values = "A1", range_name
+        self._write(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.backend.hit("batch_update")
+        for d in data:
+            self._write(d["range"], d["values"])
+
+    def append_rows(self, values, **kwargs):
+        self.spreadsheet.backend.hit("append_rows")
+        self._rows.extend([[str(v) for v in row] for row in values])
+
+    def append_row(self, values, **kwargs):
+        self.append_rows([values], **kwargs)
+
+class FakeSpreadsheet:
+    def __init__(self, key: str, sheets: dict, backend: FakeBackend | None = None):
+        self.id = key
+        self.backend = backend or FakeBackend()
+        self._sheets = {}
+        for i, (title, rows) in enumerate(sheets.items()):
+            self._sheets[title] = FakeWorksheet(self, title, rows, sheet_id=i)
+
+    def _split(self, a1: str):
+        title, _, rng = a1.rpartition("!")
+        title = title.strip("'").replace("''", "'")
+        if title not in self._sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title], rng
+
+    @property
+    def sheet1(self) -> FakeWorksheet:
+        self.backend.hit("fetch_sheet_metadata")
+        return next(iter(self._sheets.values()))
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.backend.hit("fetch_sheet_metadata")
+        if title not in self._sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def worksheets(self, **kwargs) -> list[FakeWorksheet]:
+        self.backend.hit("fetch_sheet_metadata")
+        return list(self._sheets.values())
+
+    def add_worksheet(self, title: str, rows: int = 100, cols: int = 26, **kwargs) -> FakeWorksheet:
+        self.backend.hit("batch_update_spreadsheet")
+        ws = self._sheets[title] = FakeWorksheet(self, title, [], sheet_id=len(self._sheets))
+        return ws
+
+    def values_batch_get(self, ranges, params=None) -> dict:
+        self.backend.hit("values_batch_get")
+        out = []
+        for a1 in ranges:
+            ws, rng = self._split(a1)
+            out.append({"range": a1, "values": ws._values(rng)})
+        return {"spreadsheetId": self.id, "valueRanges": out}
+
+    def values_batch_update(self, body=None, **kwargs) -> dict:
+        self.backend.hit("values_batch_update")
+        for d in (body or {}).get("data", []):
+            ws, rng = self._split(d["range"])
+            ws._write(rng, d["values"])
+        return {"spreadsheetId": self.id}
+
+class FakeClient:
+    def __init__(self, books: dict | None = None):
+        self.books = dict(books or {})
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        book = self.books.get(key)
+        if book is None:
+            raise gspread.exceptions.SpreadsheetNotFound(key)
+        book.backend.hit("open_by_key")
+        return book
+
+def install(client: FakeClient, sheet_key: str):
+    """
+    main 을 import 하기 전에 불러서 gspread 인증을 client 로 바꿔치기한다.
+    디스코드에는 접속하지 않으므로 토큰/인증 정보는 형식만 맞춘 값이면 된다.
+    """
+    from google.oauth2.service_account import Credentials
+
+    os.environ.setdefault("DISCORD_BOT_TOKEN", "bench")
+    os.environ.setdefault("GOOGLE_CREDS", "{}")
+    os.environ["SHEET_KEY"] = sheet_key
+    os.environ.setdefault("METRICS_PORT", "0")
+    gspread.authorize = lambda creds, **kwargs: client
+    Credentials.from_service_account_info = classmethod(lambda cls, info, **kwargs: None)
@@ -3,19 +3,111 @@ import discord
 from discord.ext import commands
 from discord.ui import Button, View
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+from urllib3.connection import HTTPConnection
 from datetime import datetime, timedelta, timezone
 import random
 import os
+import io
 import json
+import logging
 import sys
 import re
+import signal
+import socket
+import sqlite3
+import subprocess
+import asyncio
+import atexit
+import collections
+import functools
+import contextlib
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from flask import Flask, Response
+from werkzeug.serving import make_server
+
+import battle
+import metrics
+import profiler
+import shared_state
+from profiler import span
+from battle import BATTLE_START_HP, BattleState, Rejected, Attacked, Defended, LastStrike, Ended
 
 KST = timezone(timedelta(hours=9))
 
+# ====== 메트릭 ======
+# /metrics 로 내보내는 Prometheus 형식 지표. 명령 이름은 contextvar 로 시트 I/O 스레드까지 따라간다.
+METRICS_PORT = int(os.getenv("METRICS_PORT", os.getenv("PORT", "8080")))  # 0 이면 HTTP 서버를 띄우지 않음
+
+registry = metrics.Registry()
+COMMAND_LATENCY = registry.histogram("haewoo_command_seconds", "명령 처리 시간", ("command", "status"))
+SHEETS_REQUESTS = registry.counter("haewoo_sheets_requests_total", "구글 시트 HTTP 요청 수", ("command", "worksheet", "method"))
+SHEETS_ERRORS = registry.counter("haewoo_sheets_errors_total", "구글 시트 요청 오류 수 (재시도 포함)", ("command", "worksheet", "status"))
+SHEETS_LATENCY = registry.histogram("haewoo_sheets_request_seconds", "구글 시트 HTTP 요청 시간", ("method",))
+DISCORD_SEND_LATENCY = registry.histogram("haewoo_discord_send_seconds", "디스코드 메시지 전송/수정 시간", ("kind",))
+LOOP_LAG = registry.gauge("haewoo_event_loop_lag_seconds", "이벤트 루프 지연")
+ACTIVE_BATTLES = registry.gauge("haewoo_active_battles", "진행 중 전투 수", fn=lambda: len(active_battles))
+
+current_command = contextvars.ContextVar("current_command", default="-")
+
+# ====== 진단 (프로파일러 / 느린 명령) ======
+SLOW_COMMAND_SECONDS = float(os.getenv("SLOW_COMMAND_SECONDS", "2.0"))  # 이보다 오래 걸린 명령의 구간 기록을 보관
+SLOW_COMMAND_KEEP = int(os.getenv("SLOW_COMMAND_KEEP", "50"))
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+slow_commands = profiler.SlowCommandLog(SLOW_COMMAND_SECONDS, SLOW_COMMAND_KEEP)
+sampling_profiler = profiler.SamplingProfiler(PROFILE_INTERVAL)
+
+class TimedContext(commands.Context):
+    async def send(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            with span("discord.send"):
+                return await super().send(*args, **kwargs)
+        finally:
+            DISCORD_SEND_LATENCY.observe(time.perf_counter() - t0, "message")
+
+# ====== 샤딩 / 다중 워커 ======
+# BOT_SHARDS: 비우면 게이트웨이 연결 하나, "auto" 면 디스코드 권장 샤드 수, 숫자면 전체 샤드 수 (AutoShardedBot).
+# WORKER_PROCESSES=K(>1) 로 python main.py 를 실행하면 감독 프로세스가 되어 워커 K개를 띄운다.
+#   워커 i 는 전체 샤드 중 i, i+K, i+2K ... 번만 맡는다 (WORKER_INDEX 는 감독이 넣어 줌).
+#   전투 상태와 쓰기 락은 같은 호스트의 워커끼리 SHARED_STATE_PATH(SQLite) 로 나눠 쓴다.
+# 여러 호스트/다이노에 직접 나눠 띄울 때는 WORKER_PROCESSES, WORKER_INDEX, BOT_SHARDS 를 각각 지정.
+BOT_SHARDS = os.getenv("BOT_SHARDS", "").strip().lower()
+WORKER_PROCESSES = max(1, int(os.getenv("WORKER_PROCESSES", "1")))
+WORKER_INDEX = os.getenv("WORKER_INDEX")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3")
+MULTI_PROCESS = WORKER_PROCESSES > 1
+# 임대 주인 이름. pid 가 아니라 워커 번호로 정해 두어, 다시 시작한 워커가 이전 실행의 임대를 자기 것으로 알아보고 정리한다.
+WORKER_ID = f"{socket.gethostname()}:{f'worker{WORKER_INDEX}' if WORKER_INDEX is not None else os.getpid()}"
+
+SHARD_COUNT = int(BOT_SHARDS) if BOT_SHARDS.isdigit() else None
+SHARD_IDS = None
+if MULTI_PROCESS and WORKER_INDEX is not None and SHARD_COUNT:
+    SHARD_IDS = [s for s in range(SHARD_COUNT) if s % WORKER_PROCESSES == int(WORKER_INDEX)]
+
+class HaewooBot(commands.Bot):
+    async def get_context(self, origin, /, *, cls=TimedContext):
+        return await super().get_context(origin, cls=cls)
+
+class HaewooShardedBot(commands.AutoShardedBot):
+    async def get_context(self, origin, /, *, cls=TimedContext):
+        return await super().get_context(origin, cls=cls)
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+if BOT_SHARDS or SHARD_IDS:
+    bot = HaewooShardedBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = HaewooBot(command_prefix='!', intents=intents)
 
 # 🔐 환경변수 확인
 DISCORD_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
@@ -31,25 +123,985 @@ if missing:
     print(f"❌ 누락된 환경변수: {', '.join(missing)}")
     sys.exit(1)
 
-# 🔐 구글 시트 인증
+SUPERVISOR_RESTART_MAX = 60.0  # 워커가 연달아 죽을 때 다시 띄우기 전 최대 대기(초)
+
+def _recommended_shards() -> int:
+    resp = requests.get(
+        "https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {DISCORD_TOKEN}"}, timeout=10
+    )
+    resp.raise_for_status()
+    return int(resp.json()["shards"])
+
+def _run_supervisor():
+    """
+    워커 프로세스 WORKER_PROCESSES 개를 띄우고 지켜본다.
+    죽은 워커는 (연달아 죽으면 점점 길게) 기다렸다가 다시 띄우고, SIGTERM/SIGINT 를 받으면 모두 끈다.
+    """
+    shard_count = SHARD_COUNT or _recommended_shards()
+    shard_count = max(shard_count, WORKER_PROCESSES)  # 샤드가 없는 워커가 생기지 않게
+    base_port = int(os.getenv("METRICS_PORT", os.getenv("PORT", "8080")))
+
+    def spawn(i: int) -> subprocess.Popen:
+        env = dict(os.environ, WORKER_INDEX=str(i), BOT_SHARDS=str(shard_count))
+        if base_port > 0:
+            env["METRICS_PORT"] = str(base_port + i)  # 워커마다 /metrics 포트를 하나씩
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    procs = {i: spawn(i) for i in range(WORKER_PROCESSES)}
+    started = {i: time.monotonic() for i in procs}
+    failures = collections.Counter()
+    restart_at = {}
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+    print(f"🧩 워커 {WORKER_PROCESSES}개 / 샤드 {shard_count}개로 시작합니다.")
+
+    while not stopping.wait(1.0):
+        now = time.monotonic()
+        for i, p in procs.items():
+            if i in restart_at:
+                if now >= restart_at[i]:
+                    del restart_at[i]
+                    procs[i], started[i] = spawn(i), now
+                continue
+            if p.poll() is None:
+                continue
+            failures[i] = 0 if now - started[i] > SUPERVISOR_RESTART_MAX else failures[i] + 1
+            delay = min(SUPERVISOR_RESTART_MAX, 2.0 ** failures[i])
+            print(f"⚠️ 워커 {i} 종료 (코드 {p.returncode}) → {delay:.0f}초 후 다시 시작")
+            restart_at[i] = now + delay
+
+    for p in procs.values():
+        if p.poll() is None:
+            p.terminate()
+    for p in procs.values():
+        try:
+            p.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+if __name__ == "__main__" and MULTI_PROCESS and WORKER_INDEX is None:
+    _run_supervisor()
+    sys.exit(0)
+
+# ====== 길드별 시트 설정 ======
+# 한 프로세스가 여러 서버(길드)를 맡도록 길드 ID → (문서 키, 워크시트 이름, 인증 정보 환경변수) 를 둔다.
+# GUILD_SHEETS(JSON) 또는 GUILD_SHEETS_PATH(JSON 파일):
+#   {"123456789012345678": {"sheet_key": "...", "worksheets": {"체력값": "HP"}, "creds": "GOOGLE_CREDS_B"}}
+# 목록에 없는 길드와 DM 은 SHEET_KEY / GOOGLE_CREDS 기본 문서를 쓴다.
+# 코드 안의 워크시트 이름("체력값", "명단" 등)은 논리 이름이고, 실제 이름은 worksheets 로 바꿀 수 있다.
+class GuildSheets:
+    __slots__ = ("key", "titles", "creds")
+
+    def __init__(self, key: str, titles: dict | None = None, creds: str = "GOOGLE_CREDS"):
+        self.key = key
+        self.titles = dict(titles or {})
+        self.creds = creds
+
+    def title(self, logical: str) -> str:
+        return self.titles.get(logical, logical)
+
+def _load_guild_sheets() -> dict:
+    raw = os.getenv("GUILD_SHEETS")
+    path = os.getenv("GUILD_SHEETS_PATH")
+    if not raw and path:
+        with open(path, encoding="utf-8") as f:
+            raw = f.read()
+    out = {}
+    for guild_id, conf in (json.loads(raw) if raw else {}).items():
+        out[int(guild_id)] = GuildSheets(conf["sheet_key"], conf.get("worksheets"), conf.get("creds", "GOOGLE_CREDS"))
+    return out
+
+try:
+    GUILD_SHEETS = _load_guild_sheets()
+except Exception as e:
+    print("❌ 길드별 시트 설정(GUILD_SHEETS)을 읽지 못했습니다:", e)
+    sys.exit(1)
+DEFAULT_SHEETS = GuildSheets(SHEET_KEY)
+current_sheets = contextvars.ContextVar("current_sheets", default=DEFAULT_SHEETS)
+
+def sheets_for_guild(guild_id: int | None) -> GuildSheets:
+    return GUILD_SHEETS.get(guild_id, DEFAULT_SHEETS) if guild_id is not None else DEFAULT_SHEETS
+
+def all_guild_sheets() -> list[GuildSheets]:
+    return list(dict.fromkeys([DEFAULT_SHEETS, *GUILD_SHEETS.values()]))
+
+# ====== 시트 요청 한도(쿼터) 관리 ======
+# gspread 의 HTTP 요청은 모두 QuotaHTTPClient 를 거친다.
+# - 토큰 버킷으로 분당 요청 수를 맞추고, 버킷의 일부(SHEETS_BULK_RESERVE)는 대화형 명령 전용으로 남겨 둔다
+#   (!전체, 복제본 갱신, 지연 쓰기 반영 같은 대량 작업은 bulk_lane() 안에서 실행)
+# - 429 / 5xx / 타임아웃은 지터를 준 지수 백오프로 재시도 → 오류 대신 조금 늦은 응답
+SHEETS_QUOTA_PER_MIN = float(os.getenv("SHEETS_QUOTA_PER_MIN", "60"))
+SHEETS_BULK_RESERVE = float(os.getenv("SHEETS_BULK_RESERVE", "0.25"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_BASE = 0.5
+SHEETS_BACKOFF_CAP = 32.0
+SHEETS_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+sheet_lane = contextvars.ContextVar("sheet_lane", default=LANE_INTERACTIVE)
+
+@contextlib.contextmanager
+def bulk_lane():
+    """이 블록 안에서 나가는 시트 요청은 대량 작업 우선순위로 처리."""
+    token = sheet_lane.set(LANE_BULK)
+    try:
+        yield
+    finally:
+        sheet_lane.reset(token)
+
+class TokenBucket:
+    def __init__(self, per_minute: float, bulk_reserve: float):
+        self._rate = per_minute / 60.0
+        self._capacity = per_minute
+        self._tokens = per_minute
+        self._reserve = per_minute * bulk_reserve
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def acquire(self, lane: str = LANE_INTERACTIVE):
+        """토큰 1개를 얻을 때까지 (스레드를) 대기. 대량 작업은 예약분 위로 남은 토큰만 쓴다."""
+        floor = self._reserve if lane == LANE_BULK else 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens - 1 >= floor:
+                    self._tokens -= 1
+                    return
+                wait = (floor + 1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def drain(self):
+        """429 를 받으면 버킷을 비워 모든 요청이 함께 물러나게 한다."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+# 워커 프로세스가 여럿이면 같은 서비스 계정 한도를 나눠 쓴다
+SHEETS_QUOTA_PER_PROCESS = SHEETS_QUOTA_PER_MIN / WORKER_PROCESSES
+sheet_quota = TokenBucket(SHEETS_QUOTA_PER_PROCESS, SHEETS_BULK_RESERVE)
+
+# 문서(길드)마다 전체 한도의 GUILD_QUOTA_SHARE 만큼만 쓰는 버킷을 하나 더 둬서
+# 한 길드의 대량 작업이 다른 길드의 요청을 굶기지 않게 한다. 문서가 하나뿐이면 끈다.
+GUILD_QUOTA_SHARE = float(os.getenv("GUILD_QUOTA_SHARE", "0.5" if GUILD_SHEETS else "1"))
+SPREADSHEET_ID_RE = re.compile(r"/spreadsheets/([^/:?]+)")
+
+class FairShareQuota:
+    def __init__(self, per_minute: float, share: float, bulk_reserve: float):
+        self._per_minute = per_minute * share
+        self._enabled = share < 1
+        self._bulk_reserve = bulk_reserve
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, spreadsheet_id: str | None, lane: str = LANE_INTERACTIVE):
+        if not self._enabled or not spreadsheet_id:
+            return
+        with self._lock:
+            bucket = self._buckets.get(spreadsheet_id)
+            if bucket is None:
+                bucket = self._buckets[spreadsheet_id] = TokenBucket(self._per_minute, self._bulk_reserve)
+        bucket.acquire(lane)
+
+sheet_fair_share = FairShareQuota(SHEETS_QUOTA_PER_PROCESS, GUILD_QUOTA_SHARE, SHEETS_BULK_RESERVE)
+
+def _worksheet_of(endpoint: str, params=None, body=None) -> str:
+    """요청 URL/파라미터에서 워크시트 이름 추출 (메트릭 라벨용). 메타데이터 요청은 '-'."""
+    rng = None
+    if "/values/" in endpoint:
+        rng = unquote(endpoint.split("/values/", 1)[1])
+    elif params and params.get("ranges"):
+        ranges = params["ranges"]
+        rng = ranges[0] if isinstance(ranges, (list, tuple)) else ranges
+    elif body and body.get("data"):
+        rng = body["data"][0].get("range")
+    if not rng or "!" not in rng:
+        return "-"
+    return rng.rsplit("!", 1)[0].strip("'")
+
+# ====== 시트 HTTP 전송 계층 ======
+# - 연결 풀을 시트 I/O 스레드 수보다 넉넉히 두고 TCP keepalive 를 켜서, 유휴 뒤 첫 요청도 새 TLS 연결 없이 나가게 한다
+# - 응답 압축: 구글 API 는 Accept-Encoding 과 함께 User-Agent 에 "gzip" 이 있어야 gzip 으로 보낸다 (큰 범위 읽기용)
+# - 액세스 토큰은 만료 SHEETS_TOKEN_REFRESH_MARGIN 초 전에 백그라운드 스레드가 미리 갱신한다
+#   → 명령 처리 중에 동기 갱신(google-auth 는 만료 3분 45초 전부터 요청 경로에서 갱신)이 끼지 않는다
+SHEETS_HTTP_POOL = int(os.getenv("SHEETS_HTTP_POOL", "16"))
+SHEETS_CONNECT_TIMEOUT = float(os.getenv("SHEETS_CONNECT_TIMEOUT", "5"))
+SHEETS_READ_TIMEOUT = float(os.getenv("SHEETS_READ_TIMEOUT", "60"))
+SHEETS_TOKEN_REFRESH_MARGIN = float(os.getenv("SHEETS_TOKEN_REFRESH_MARGIN", "600"))
+SHEETS_TOKEN_REFRESH_BACKOFF_CAP = 60.0  # 선제 갱신 실패 시 재시도 간격 상한
+SHEETS_USER_AGENT = "haewoo-bot (gzip)"
+
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _opt, _val in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 20), ("TCP_KEEPCNT", 3)):
+    if hasattr(socket, _opt):  # 리눅스 전용 옵션
+        KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _opt), _val))
+
+TOKEN_REFRESHES = registry.counter("haewoo_sheets_token_refresh_total", "구글 액세스 토큰 선제 갱신 횟수", ("status",))
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+def _tune_session(session: requests.Session):
+    adapter = KeepAliveAdapter(pool_connections=4, pool_maxsize=SHEETS_HTTP_POOL)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip", "User-Agent": SHEETS_USER_AGENT})
+
+class QuotaHTTPClient(gspread.http_client.HTTPClient):
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        _tune_session(self.session)
+        self.set_timeout((SHEETS_CONNECT_TIMEOUT, SHEETS_READ_TIMEOUT))
+        # 토큰 발급 요청은 인증이 붙는 self.session 이 아니라 별도 세션으로 (갱신 중 재귀 갱신 방지)
+        self._token_session = requests.Session()
+        _tune_session(self._token_session)
+        self._refresher = None
+
+    def start_token_refresh(self, name: str):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name=name, daemon=True)
+            self._refresher.start()
+
+    def _seconds_to_refresh(self) -> float:
+        expiry = self.auth.expiry  # google-auth 는 naive UTC
+        if not self.auth.token or expiry is None:
+            return 0.0
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds() - SHEETS_TOKEN_REFRESH_MARGIN
+
+    def _refresh_loop(self):
+        failures = 0
+        while True:
+            wait = self._seconds_to_refresh()
+            if wait > 0:
+                time.sleep(min(wait, 300))  # 시계가 튀어도 5분마다 다시 계산
+                continue
+            try:
+                self.auth.refresh(GoogleAuthRequest(self._token_session))
+                TOKEN_REFRESHES.inc("ok")
+                failures = 0
+            except Exception as e:
+                # 실패해도 토큰이 아직 유효한 동안 계속 재시도, 끝내 실패하면 요청 경로의 기본 갱신이 이어받는다
+                TOKEN_REFRESHES.inc("error")
+                print(f"⚠️ 구글 토큰 선제 갱신 실패: {e}")
+                time.sleep(min(SHEETS_TOKEN_REFRESH_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** failures))
+                failures += 1
+
+    def request(self, method, endpoint, *args, **kwargs):
+        # values:append 는 멱등이 아니다: 서버가 반영한 뒤 타임아웃/5xx 가 나면 재시도가 행을 한 번 더 붙인다.
+        # 그래서 429(반영 전 거절)만 재시도하고 나머지는 호출자(감사 로그)가 확인 후 처리한다.
+        idempotent = not (method.upper() == "POST" and ":append" in endpoint)
+        lane = sheet_lane.get()
+        command = current_command.get()
+        worksheet = _worksheet_of(endpoint, kwargs.get("params"), kwargs.get("json"))
+        m = SPREADSHEET_ID_RE.search(endpoint)
+        book_id = m.group(1) if m else None
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            sheet_fair_share.acquire(book_id, lane)  # 문서별 몫 먼저, 그다음 전체 한도
+            sheet_quota.acquire(lane)
+            SHEETS_REQUESTS.inc(command, worksheet, method.upper())
+            t0 = time.perf_counter()
+            try:
+                with span(f"sheets.{method.upper()} {worksheet}"):
+                    return super().request(method, endpoint, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                SHEETS_ERRORS.inc(command, worksheet, str(status))
+                if status not in SHEETS_RETRY_STATUSES or attempt == SHEETS_MAX_RETRIES:
+                    raise
+                if not idempotent and status != 429:
+                    raise
+                if status == 429:
+                    sheet_quota.drain()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                SHEETS_ERRORS.inc(command, worksheet, "connection")
+                if attempt == SHEETS_MAX_RETRIES or not idempotent:
+                    raise
+            finally:
+                SHEETS_LATENCY.observe(time.perf_counter() - t0, method.upper())
+            time.sleep(random.uniform(0, min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt)))
+
+# 🔐 구글 시트 인증 (백그라운드)
+# 디스코드 접속을 막지 않도록 인증/문서 열기는 별도 스레드에서 하고, 실패하면 물러났다가 다시 시도한다.
+# 준비되기 전에 들어온 명령은 시트에 닿는 순간 SHEETS_READY_WAIT 초까지 기다린 뒤 안내 메시지로 실패한다.
 scope = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
-try:
-    creds_dict = json.loads(GOOGLE_CREDS)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    gclient = gspread.authorize(creds)
-    sheet = gclient.open_by_key(SHEET_KEY).sheet1  # 기본은 1번째 시트
-except Exception as e:
-    print("❌ 구글 스프레드시트 인증/접속 실패:", e)
-    sys.exit(1)
+SHEETS_READY_WAIT = float(os.getenv("SHEETS_READY_WAIT", "15"))
+SHEETS_CONNECT_BACKOFF_CAP = 60.0
+
+class SheetsNotReady(RuntimeError):
+    pass
+
+class SheetsConnector:
+    """인증 정보 하나(환경변수 이름)에 대한 클라이언트. 같은 인증을 쓰는 문서들이 함께 쓴다."""
+
+    def __init__(self, creds_name: str, probe_key: str):
+        self.creds_name = creds_name
+        self._probe_key = probe_key  # 연결 확인용으로 처음 열어 볼 문서
+        self._client = None
+        self._ready = threading.Event()
+        self._thread = None
+        self.last_error = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def connect(self):
+        """인증 + 문서 열기 한 번. 성공하면 핸들 캐시에 문서를 넣고 준비 완료."""
+        raw = os.getenv(self.creds_name)
+        if not raw:
+            raise RuntimeError(f"환경변수 {self.creds_name} 이(가) 없습니다.")
+        creds = ServiceAccountCredentials.from_service_account_info(json.loads(raw), scopes=scope)
+        client = gspread.authorize(creds, http_client=QuotaHTTPClient)
+        book = client.open_by_key(self._probe_key)
+        self._client = client
+        http = getattr(client, "http_client", None)
+        if isinstance(http, QuotaHTTPClient):  # 벤치용 메모리 대역에는 HTTP 계층이 없다
+            http.start_token_refresh(f"sheets-token-{self.creds_name}")
+        sheet_handles.seed(self._probe_key, book)
+        self._ready.set()
+
+    def start(self):
+        if self._thread is None and not self.ready:
+            self._thread = threading.Thread(target=self._run, name=f"sheets-connect-{self.creds_name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        attempt = 0
+        while not self.ready:
+            try:
+                self.connect()
+                print(f"✅ 구글 스프레드시트 연결 완료 ({self.creds_name})")
+            except Exception as e:
+                self.last_error = e
+                delay = min(SHEETS_CONNECT_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt)
+                print(f"❌ 구글 스프레드시트 인증/접속 실패 ({self.creds_name}, {delay:.0f}초 뒤 재시도): {e}")
+                attempt += 1
+                time.sleep(delay)
+
+    def client(self, timeout: float = SHEETS_READY_WAIT):
+        """준비된 gspread 클라이언트. 시트 I/O 스레드에서 호출되며 준비 전이면 timeout 까지 기다린다."""
+        if not self._ready.wait(timeout):
+            raise SheetsNotReady("구글 시트 연결을 준비 중입니다. 잠시 후 다시 시도해 주세요.")
+        return self._client
+
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._ready.wait, timeout)
+
+class SheetsClientRegistry:
+    """문서 키 → 인증 정보 → 클라이언트. 인증 정보마다 클라이언트(HTTP 세션) 하나를 만들어 공유한다."""
+
+    def __init__(self, configs):
+        self._connectors = {}
+        self._creds_of_key = {}
+        for cfg in configs:
+            self._creds_of_key.setdefault(cfg.key, cfg.creds)
+            if cfg.creds not in self._connectors:
+                self._connectors[cfg.creds] = SheetsConnector(cfg.creds, cfg.key)
+
+    def connector(self, key: str) -> SheetsConnector:
+        return self._connectors.get(self._creds_of_key.get(key, DEFAULT_SHEETS.creds)) or self._connectors[DEFAULT_SHEETS.creds]
+
+    @property
+    def ready(self) -> bool:
+        return all(c.ready for c in self._connectors.values())
+
+    def connect(self):
+        for c in self._connectors.values():
+            c.connect()
+
+    def start(self):
+        for c in self._connectors.values():
+            c.start()
+
+    def client(self, key: str, timeout: float = SHEETS_READY_WAIT):
+        return self.connector(key).client(timeout)
+
+    async def wait_ready(self, key: str | None = None, timeout: float | None = None) -> bool:
+        return await self.connector(key or DEFAULT_SHEETS.key).wait_ready(timeout)
+
+sheets = SheetsClientRegistry(all_guild_sheets())
+SHEETS_READY = registry.gauge("haewoo_sheets_ready", "구글 시트 연결/예열 완료 여부 (0/1)", fn=lambda: float(warmup_done.is_set()))
+
+# ====== 시트 핸들 캐시 ======
+# open_by_key / worksheet 는 매번 메타데이터 요청이 나가므로 (문서 키, 시트 이름) 단위로 핸들을 재사용.
+# TTL 이 지나거나, 시트를 찾지 못하거나, 인증 오류(401)가 나면 비우고 다시 연다.
+SHEET_HANDLE_TTL = float(os.getenv("SHEET_HANDLE_TTL", "600"))
+
+class SheetHandleCache:
+    def __init__(self, client_fn, ttl: float):
+        self._client_fn = client_fn  # 문서 키 → 준비된 클라이언트
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._books = {}   # key -> (Spreadsheet, 저장 시각)
+        self._sheets = {}  # (key, title) -> (Worksheet, 저장 시각)
+
+    def _fresh(self, stamp: float) -> bool:
+        return time.monotonic() - stamp < self._ttl
+
+    def seed(self, key: str, book):
+        """이미 열어 둔 Spreadsheet 를 캐시에 등록 (시작 시 연 문서 재사용)."""
+        with self._lock:
+            self._books[key] = (book, time.monotonic())
+
+    def spreadsheet(self, key: str):
+        with self._lock:
+            hit = self._books.get(key)
+            if hit and self._fresh(hit[1]):
+                return hit[0]
+        book = self._client_fn(key).open_by_key(key)
+        with self._lock:
+            self._books[key] = (book, time.monotonic())
+        return book
+
+    def worksheet(self, key: str, title: str):
+        with self._lock:
+            hit = self._sheets.get((key, title))
+            if hit and self._fresh(hit[1]):
+                return hit[0]
+        book = self.spreadsheet(key)
+        # 한 번의 메타데이터 요청으로 모든 워크시트 핸들을 받아 함께 캐시
+        # 네트워크 요청은 락 밖에서 (쿼터 대기/재시도 중에도 다른 스레드의 캐시 조회는 막지 않게)
+        worksheets = book.worksheets()
+        now = time.monotonic()
+        found = None
+        with self._lock:
+            for w in worksheets:
+                self._sheets[(key, w.title)] = (w, now)
+                if w.title == title:
+                    found = w
+        if found is None:
+            self.invalidate(key)
+            found = self.spreadsheet(key).worksheet(title)  # 그래도 없으면 WorksheetNotFound
+            with self._lock:
+                self._sheets[(key, title)] = (found, time.monotonic())
+        return found
+
+    def invalidate(self, key: str | None = None, title: str | None = None):
+        """key 가 없으면 전체, title 이 없으면 해당 문서 전체를 비운다."""
+        with self._lock:
+            if key is None:
+                self._books.clear()
+                self._sheets.clear()
+            elif title is None:
+                self._books.pop(key, None)
+                for k in [k for k in self._sheets if k[0] == key]:
+                    del self._sheets[k]
+            else:
+                self._sheets.pop((key, title), None)
+
+sheet_handles = SheetHandleCache(sheets.client, SHEET_HANDLE_TTL)
+
+# ====== 동일 읽기 합치기(single-flight) ======
+# 여러 명령이 동시에 같은 범위를 읽으면 실제 요청은 하나만 보내고 결과를 나눠 받는다.
+# 작업 스레드에서 동작하며, 공유 결과는 읽기 전용으로만 써야 한다.
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.shared = 0  # 합쳐진(요청을 아낀) 횟수
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+sheet_reads = SingleFlight()
+
+def coalesced_read(sh, method: str, *args):
+    """sh.<method>(*args) 를 같은 워크시트·같은 인자의 진행 중 요청과 합쳐 실행."""
+    key = (getattr(sh, "spreadsheet_id", None), sh.title, method, repr(args))
+    return sheet_reads.do(key, getattr(sh, method), *args)
+
+# ====== 이름 → 행 인덱스 ======
+# 명단/체력값 B열을 매번 통째로 받는 대신, 한 번 읽어 dict 로 들고 있는다.
+# - 모르는 이름이면 알고 있는 마지막 행 이후(꼬리)만 추가로 읽는다.
+# - 행 값을 읽을 때 B열도 같이 읽어 이름이 다르면(행 이동/삭제) 인덱스를 버린다.
+NAME_INDEX_TTL = float(os.getenv("NAME_INDEX_TTL", "300"))
+
+def _col_letter(col: int) -> str:
+    return gspread.utils.rowcol_to_a1(1, col).rstrip("0123456789")
+
+class NameRowIndex:
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # (문서 id, 시트 이름, 열) -> {"rows": {이름: 행}, "last": 마지막 행, "at": 시각}
+
+    @staticmethod
+    def _key(sh, col: int):
+        return (getattr(sh, "spreadsheet_id", None), sh.title, col)
+
+    def seed(self, spreadsheet_id: str, title: str, col: int, values):
+        """이미 받아 둔 열 값(1행부터)으로 인덱스를 채운다 (복제본 갱신 시 재사용)."""
+        rows = {}
+        self._absorb(rows, values, 1)
+        with self._lock:
+            self._entries[(spreadsheet_id, title, col)] = {"rows": rows, "last": len(values), "at": time.monotonic()}
+
+    @staticmethod
+    def _absorb(rows: dict, values, start_row: int):
+        for idx, val in enumerate(values, start=start_row):
+            nm = (val or "").strip()
+            if nm and nm not in rows:  # 같은 이름이 여러 번이면 첫 행 우선 (기존 동작)
+                rows[nm] = idx
+
+    def _load(self, sh, col: int):
+        values = coalesced_read(sh, "col_values", col)
+        rows = {}
+        self._absorb(rows, values, 1)
+        entry = {"rows": rows, "last": len(values), "at": time.monotonic()}
+        with self._lock:
+            self._entries[self._key(sh, col)] = entry
+        return entry
+
+    def _extend(self, sh, col: int, entry):
+        letter = _col_letter(col)
+        start = entry["last"] + 1
+        try:
+            tail = coalesced_read(sh, "get", f"{letter}{start}:{letter}")
+        except gspread.exceptions.APIError as e:
+            # 이름이 시트 마지막 행까지 차 있으면 그 아래 범위는 그리드 밖(400) → 새 행 없음
+            if e.response.status_code != 400 or "grid limits" not in str(e):
+                raise
+            tail = []
+        values = [(r[0] if r else "") for r in tail]
+        with self._lock:
+            self._absorb(entry["rows"], values, start)
+            entry["last"] = max(entry["last"], start + len(values) - 1)
+
+    def find(self, sh, name: str, col: int = 2) -> int | None:
+        target = (name or "").strip()
+        with self._lock:
+            entry = self._entries.get(self._key(sh, col))
+        if entry is None or time.monotonic() - entry["at"] >= self._ttl:
+            entry = self._load(sh, col)
+        elif target not in entry["rows"]:
+            self._extend(sh, col, entry)  # 새로 추가된 행만 확인
+        return entry["rows"].get(target)
+
+    def invalidate(self, sh=None, col: int = 2):
+        with self._lock:
+            if sh is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(sh, col), None)
+
+name_index = NameRowIndex(NAME_INDEX_TTL)
+
+# 쓰기 직전 재확인(compare-and-set): 봇 밖(시트 직접 편집 등)에서 값이 바뀌었으면 다시 계산
+SHEET_CAS = os.getenv("SHEET_CAS", "0") == "1"
+SHEET_CAS_RETRIES = 3
+
+def _cells_unchanged(sh, expected: dict) -> bool:
+    """{A1 셀: 앞서 읽은 원문} 이 지금도 같은지 batch_get 한 번으로 확인."""
+    got = sh.batch_get(list(expected))
+    for (a1, before), vr in zip(expected.items(), got):
+        now = (vr[0][0] if vr and vr[0] else "") or ""
+        if now.strip() != (before or "").strip():
+            return False
+    return True
+
+class ConcurrentEditError(RuntimeError):
+    pass
+
+def _locate_rows(sh, names, last_col: int, name_col: int = 2):
+    """
+    여러 이름의 행을 인덱스로 찾고, batch_get 한 번으로 각 행의 name_col~last_col 값을 읽는다.
+    읽은 이름이 다르면 행이 밀린 것 → 인덱스를 다시 읽고 해당 이름만 한 번 재시도.
+    반환: {이름: (row, values)} — 못 찾은 이름은 빠짐. values[0] 이 name_col 값.
+    """
+    first, last = _col_letter(name_col), _col_letter(last_col)
+    width = last_col - name_col + 1
+    found = {}
+    pending = [(n or "").strip() for n in names]
+    for _ in range(2):
+        rows = {}
+        for nm in pending:
+            row = name_index.find(sh, nm, name_col)
+            if row:
+                rows[nm] = row
+        if not rows:
+            break
+        got = coalesced_read(sh, "batch_get", [f"{first}{r}:{last}{r}" for r in rows.values()])
+        moved = []
+        for (nm, row), vr in zip(rows.items(), got):
+            values = list(vr[0]) if vr else []
+            values += [""] * (width - len(values))
+            if (values[0] or "").strip() == nm:
+                found[nm] = (row, values)
+            else:
+                moved.append(nm)
+        if not moved:
+            break
+        name_index.invalidate(sh, name_col)
+        pending = moved
+    return found
+
+def _locate_row(sh, name: str, last_col: int, name_col: int = 2):
+    """
+    이름 하나의 행과 name_col~last_col 값을 읽는다 (_locate_rows 단건판).
+    반환: (row, values) / 없으면 (None, None)
+    """
+    hit = _locate_rows(sh, [name], last_col, name_col).get((name or "").strip())
+    return hit if hit else (None, None)
+
+# ====== 읽기 전용 복제본 ======
+# 체력값/명단에서 봇이 쓰는 범위를 values_batch_get 한 번으로 받아 메모리에 들고 있는다.
+# 읽기 명령은 REPLICA_MAX_STALENESS 초 이내 스냅샷이면 그대로 쓰고, 아니면 새로 받는다.
+# 봇이 해당 시트에 쓰면 즉시 stale 처리 → 다음 읽기에서 갱신.
+REPLICA_MAX_STALENESS = float(os.getenv("REPLICA_MAX_STALENESS", "30"))
+REPLICA_REFRESH_INTERVAL = float(os.getenv("REPLICA_REFRESH_INTERVAL", "30"))  # 0 이면 백그라운드 갱신 안 함
+
+REPLICA_RANGES = {
+    "hp": ("체력값", "B1:D"),       # 이름(B) ~ 체력값(D)
+    "totals": ("체력값", "G2:I2"),  # 대선(G2), 사련(I2)
+    "roster": ("명단", "B1:B"),     # 이름(B) — 이름 인덱스 시드용
+}
+
+class SheetSnapshot:
+    __slots__ = ("hp", "totals", "roster", "fetched_at")
+
+    def __init__(self, hp, totals, roster, fetched_at):
+        self.hp = hp          # 체력값 1행부터의 [B, C, D] 목록
+        self.totals = totals  # (G2, I2)
+        self.roster = roster  # 명단 1행부터의 [B] 목록
+        self.fetched_at = fetched_at
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+def _pad(rows, width):
+    return [list(r) + [""] * (width - len(r)) for r in rows]
+
+def _fetch_snapshot(cfg: GuildSheets) -> SheetSnapshot:
+    book = sheet_handles.spreadsheet(cfg.key)
+    keys = list(REPLICA_RANGES)
+    ranges = [gspread.utils.absolute_range_name(cfg.title(t), r) for t, r in (REPLICA_RANGES[k] for k in keys)]
+    resp = book.values_batch_get(ranges)
+    got = {k: vr.get("values", []) for k, vr in zip(keys, resp.get("valueRanges", []))}
+    hp = _pad(got.get("hp", []), 3)
+    roster = _pad(got.get("roster", []), 1)
+    top = _pad(got.get("totals", []), 3)
+    totals = (top[0][0] or None, top[0][2] or None) if top else (None, None)
+    # 받아 온 B열로 이름 인덱스도 같이 갱신
+    name_index.seed(book.id, cfg.title("체력값"), 2, [r[0] for r in hp])
+    name_index.seed(book.id, cfg.title("명단"), 2, [r[0] for r in roster])
+    return SheetSnapshot(hp, totals, roster, time.monotonic())
+
+class SheetReplica:
+    def __init__(self, cfg: GuildSheets, max_staleness: float, interval: float):
+        self._cfg = cfg
+        self._max_staleness = max_staleness
+        self._interval = interval
+        self._snap = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def snapshot(self, max_age: float | None = None, fresh: bool = False) -> SheetSnapshot:
+        """max_age(기본 REPLICA_MAX_STALENESS) 이내 스냅샷 반환. fresh=True 면 무조건 새로 읽기."""
+        limit = self._max_staleness if max_age is None else max_age
+        snap = self._snap
+        if not fresh and snap is not None and snap.age <= limit:
+            return snap
+        async with self._lock:
+            # 기다리는 동안 다른 요청이 이미 갱신했으면 그것을 사용
+            snap = self._snap
+            if not fresh and snap is not None and snap.age <= limit:
+                return snap
+            key = ("snapshot", self._cfg.key, tuple(sorted(self._cfg.titles.items())))
+            self._snap = await sheet_io.read(sheet_reads.do, key, _fetch_snapshot, self._cfg)
+            return self._snap
+
+    def mark_stale(self):
+        if self._snap is not None:
+            self._snap.fetched_at = float("-inf")
+
+    def start(self):
+        if self._interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        sheet_lane.set(LANE_BULK)  # 백그라운드 갱신은 대량 작업 우선순위
+        current_sheets.set(self._cfg)
+        while True:
+            try:
+                await self.snapshot(max_age=self._interval / 2)
+            except Exception as e:
+                print("❌ 시트 복제본 갱신 실패:", e)
+            await asyncio.sleep(self._interval)
+
+class SheetReplicas:
+    """길드 설정마다 복제본 하나. 처음 쓰일 때 만들고, 예열 이후라면 백그라운드 갱신도 바로 시작한다."""
+
+    def __init__(self, max_staleness: float, interval: float):
+        self._max_staleness = max_staleness
+        self._interval = interval
+        self._by_cfg = {}
+        self._started = False
+
+    def get(self, cfg: GuildSheets | None = None) -> SheetReplica:
+        cfg = cfg or current_sheets.get()
+        replica = self._by_cfg.get(cfg)
+        if replica is None:
+            replica = self._by_cfg[cfg] = SheetReplica(cfg, self._max_staleness, self._interval)
+            if self._started:
+                replica.start()
+        return replica
+
+    def start(self):
+        self._started = True
+        for replica in self._by_cfg.values():
+            replica.start()
+
+sheet_replicas = SheetReplicas(REPLICA_MAX_STALENESS, REPLICA_REFRESH_INTERVAL)
+REPLICA_TITLES = {t for t, _ in REPLICA_RANGES.values()}
 
 # 🧰 유틸
 def now_kst_str(fmt="%Y-%m-%d %H:%M:%S"):
     return datetime.now(KST).strftime(fmt)
 
+# ====== 시트 I/O 게이트웨이 ======
+# gspread 는 동기(HTTP) 호출이라 이벤트 루프에서 바로 부르면 하트비트/버튼 응답까지 멈춘다.
+# 모든 워크시트 호출은 크기가 제한된 스레드 풀에서 실행한다.
+# 쓰기 잠금은 두 단계:
+# - 행 단위 (시트, 행, 열): 서로 다른 캐릭터를 건드리는 명령은 병렬로, 같은 칸은 차례로
+# - 시트 단위: !전체처럼 열 전체를 다시 쓰는 작업은 해당 시트의 행 작업이 모두 끝난 뒤 단독 실행
+# 대량 작업(복제본 갱신, 지연 반영, !전체 등)은 토큰/백오프를 기다리며 스레드를 오래 붙잡으므로
+# 별도의 작은 풀에서 돌려 대화형 명령의 스레드를 빼앗지 않게 한다.
+SHEET_IO_WORKERS = int(os.getenv("SHEET_IO_WORKERS", "8"))
+SHEET_IO_BULK_WORKERS = int(os.getenv("SHEET_IO_BULK_WORKERS", "2"))
+
+class SheetRWLock:
+    """행 작업(공유)과 시트 전체 작업(단독)을 구분하는 asyncio 읽기/쓰기 락. 단독 대기가 있으면 새 공유는 대기."""
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive and not self._waiting_exclusive)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._waiting_exclusive += 1
+            try:
+                await self._cond.wait_for(lambda: not self._exclusive and self._shared == 0)
+            finally:
+                self._waiting_exclusive -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+class RowLockManager:
+    """(시트 이름, 행, 열) 단위 asyncio 락. 정렬된 순서로 잡아 교착을 피하고, 쓰는 사람이 없으면 정리."""
+
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, 참조 수]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys):
+        keys = sorted(set(keys))
+        for k in keys:
+            entry = self._locks.setdefault(k, [asyncio.Lock(), 0])
+            entry[1] += 1
+        acquired = []
+        try:
+            for k in keys:
+                await self._locks[k][0].acquire()
+                acquired.append(k)
+            yield
+        finally:
+            for k in acquired:
+                self._locks[k][0].release()
+            for k in keys:
+                entry = self._locks[k]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[k]
+
+    def __len__(self):
+        return len(self._locks)
+
+# ====== 워커 간 공유 락 ======
+# 다중 워커 모드에서는 프로세스 안의 asyncio 락을 잡은 뒤, 같은 이름의 임대를 공유 저장소에서도 잡는다.
+# 임대는 잡고 있는 동안 주기적으로 연장되고, 워커가 죽으면 SHARED_LOCK_TTL 뒤 저절로 풀린다.
+SHARED_LOCK_TTL = float(os.getenv("SHARED_LOCK_TTL", "30"))
+SHARED_LOCK_TIMEOUT = float(os.getenv("SHARED_LOCK_TIMEOUT", "20"))
+
+shared_leases = shared_state.SharedLeases(SHARED_STATE_PATH, WORKER_ID, SHARED_LOCK_TTL) if MULTI_PROCESS else None
+if shared_leases is not None:
+    shared_leases.release_all()  # 같은 번호의 이전 실행이 죽으면서 못 푼 임대 정리
+    atexit.register(shared_leases.release_all)
+
+@contextlib.asynccontextmanager
+async def shared_hold(names, block_names=(), block_prefixes=(), ttl: float = SHARED_LOCK_TTL):
+    """names 임대를 모두 잡을 때까지 기다렸다가 블록을 실행. 단일 프로세스면 아무것도 하지 않는다."""
+    if shared_leases is None:
+        yield
+        return
+    names = sorted(set(names))
+    deadline = time.monotonic() + SHARED_LOCK_TIMEOUT
+    delay = 0.02
+    while not await asyncio.to_thread(shared_leases.try_acquire, names, ttl, block_names, block_prefixes):
+        if time.monotonic() >= deadline:
+            raise ConcurrentEditError("다른 워커가 같은 행을 수정 중입니다. 잠시 후 다시 시도하세요.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+    async def keep_alive():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            await asyncio.to_thread(shared_leases.renew, names, ttl)
+
+    renewer = asyncio.create_task(keep_alive())
+    try:
+        yield
+    finally:
+        renewer.cancel()
+        await asyncio.to_thread(shared_leases.release, names)
+
+def _resolve_rows(title: str, names, name_col: int = 2):
+    sh = ws(title)
+    return [name_index.find(sh, n, name_col) for n in names]
+
+class SheetGateway:
+    def __init__(self, max_workers: int, bulk_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheet-io")
+        self._bulk_executor = ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix="sheet-io-bulk")
+        self._sheet_locks: dict[tuple, SheetRWLock] = {}
+        self.row_locks = RowLockManager()
+
+    def _sheet_lock(self, title: str) -> SheetRWLock:
+        key = (current_sheets.get().key, title)  # 길드(문서)가 다르면 같은 이름의 시트라도 따로 잠근다
+        lock = self._sheet_locks.get(key)
+        if lock is None:
+            lock = self._sheet_locks[key] = SheetRWLock()
+        return lock
+
+    async def read(self, fn, *args, **kwargs):
+        """동기 함수 fn 을 스레드 풀에서 실행하고 결과를 돌려준다. 대량 작업 우선순위면 전용 풀에서."""
+        loop = asyncio.get_running_loop()
+        executor = self._bulk_executor if sheet_lane.get() == LANE_BULK else self._executor
+        try:
+            # contextvars(요청 우선순위 등)를 작업 스레드로 넘긴다
+            ctx = contextvars.copy_context()
+            with span(f"sheet_io {getattr(fn, '__name__', 'call')}"):
+                return await loop.run_in_executor(executor, ctx.run, functools.partial(fn, *args, **kwargs))
+        except gspread.exceptions.WorksheetNotFound:
+            sheet_handles.invalidate(current_sheets.get().key)
+            raise
+        except gspread.exceptions.APIError as e:
+            if getattr(e, "code", None) in (401, 404):  # 인증 갱신/시트 삭제 → 핸들 폐기
+                sheet_handles.invalidate()
+            raise
+
+    async def write(self, title: str, fn, *args, **kwargs):
+        """워크시트(title) 전체를 단독으로 잡고 fn 실행 (열 전체 갱신 등)."""
+        book_key = current_sheets.get().key
+        t0 = time.perf_counter()
+        async with self._sheet_lock(title).exclusive(), shared_hold(
+            [f"sheet:{book_key}:{title}"], block_prefixes=[f"row:{book_key}:{title}:"]
+        ):
+            profiler.mark(f"lock.wait {title}", t0)
+            try:
+                return await self.read(fn, *args, **kwargs)
+            finally:
+                if title in REPLICA_TITLES:
+                    sheet_replicas.get().mark_stale()
+
+    async def write_rows(self, title: str, names, col: int, fn, *args, **kwargs):
+        """
+        names 의 행을 먼저 찾아 (문서, title, row, col) 락을 잡은 뒤 fn 실행.
+        다른 행/열을 건드리는 명령끼리는 동시에 진행된다.
+        """
+        return await self.write_rows_many([(title, names, col)], fn, *args, **kwargs)
+
+    async def write_rows_many(self, targets, fn, *args, **kwargs):
+        """
+        여러 시트의 행을 함께 잡고 fn 실행 (write_rows 의 여러 시트판). targets: [(title, names, col), ...]
+        시트 락은 이름 순, 행 락은 정렬된 순서로 잡아 다른 명령과 교착하지 않는다.
+        """
+        book_key = current_sheets.get().key
+        keys = []
+        for title, names, col in targets:
+            rows = await self.read(_resolve_rows, title, list(names))
+            keys += [(book_key, title, r, col) for r in rows if r]
+        titles = sorted({title for title, _, _ in targets})
+        t0 = time.perf_counter()
+        async with contextlib.AsyncExitStack() as stack:
+            for title in titles:
+                await stack.enter_async_context(self._sheet_lock(title).shared())
+            await stack.enter_async_context(self.row_locks.hold(keys))
+            await stack.enter_async_context(shared_hold(
+                [f"row:{book_key}:{title}:{r}:{col}" for _, title, r, col in keys],
+                block_names=[f"sheet:{book_key}:{title}" for title in titles],
+            ))
+            profiler.mark(f"lock.wait {'/'.join(titles)}", t0)
+            try:
+                return await self.read(fn, *args, **kwargs)
+            finally:
+                if REPLICA_TITLES.intersection(titles):
+                    sheet_replicas.get().mark_stale()
+
+sheet_io = SheetGateway(SHEET_IO_WORKERS, SHEET_IO_BULK_WORKERS)
+
 DICE_EMOJI = {
     1: "🎲1", 2: "🎲2", 3: "🎲3",
     4: "🎲4", 5: "🎲5", 6: "🎲6"
@@ -84,9 +1136,132 @@ def _parse_names_and_amount(args):
     names = list(dict.fromkeys(names))
     return (names, amount), None
 
+@bot.event
+async def setup_hook():
+    sheets.start()  # 구글 인증은 디스코드 접속과 동시에 백그라운드에서
+    # 재시작 전 진행 중이던 전투 버튼을 다시 연결 (custom_id 로 매칭, 메시지 조회 없음)
+    for channel_id in active_battles:
+        bot.add_view(BattleView(channel_id))
+    if active_battles:
+        print(f"♻️ 진행 중이던 전투 {len(active_battles)}건을 복구했습니다.")
+
+@bot.event
+async def on_command_error(ctx, error):
+    original = getattr(error, "original", error)
+    if isinstance(original, SheetsNotReady):  # 시작 직후 시트 연결 전에 들어온 명령
+        await ctx.send(f"⏳ {original}")
+        return
+    if isinstance(error, commands.CommandInvokeError):  # 명령 안에서 잡지 않은 오류도 답은 남긴다
+        await ctx.send(f"❌ 명령 처리 실패: {original}")
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+@bot.before_invoke
+async def _before_command(ctx):
+    ctx.started_at = time.perf_counter()
+    current_command.set(ctx.command.qualified_name)
+    current_sheets.set(sheets_for_guild(ctx.guild.id if ctx.guild else None))
+    profiler.current_trace.set(profiler.Trace(ctx.command.qualified_name))
+
+@bot.after_invoke
+async def _after_command(ctx):
+    elapsed = time.perf_counter() - ctx.started_at
+    status = "error" if ctx.command_failed else "ok"
+    COMMAND_LATENCY.observe(elapsed, ctx.command.qualified_name, status)
+    trace = profiler.current_trace.get()
+    if trace is not None:
+        slow_commands.record(trace, ctx.message.content[:200], elapsed, status)
+
+# ====== 헬스체크 / 메트릭 HTTP 서버 ======
+LOOP_LAG_INTERVAL = 0.5
+LIVENESS_MAX_STALL = 10.0  # 이벤트 루프가 이 시간 이상 멈추면 liveness 실패
+_loop_heartbeat = {"at": None}
+
+async def _watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.set(max(loop.time() - t0 - LOOP_LAG_INTERVAL, 0.0))
+        _loop_heartbeat["at"] = time.monotonic()
+
+def _is_ready() -> bool:
+    return bot.is_ready() and not bot.is_closed() and warmup_done.is_set()
+
+def _start_health_server():
+    if METRICS_PORT <= 0:
+        return
+    app = Flask("haewoo")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # 스크레이프마다 접근 로그가 찍히지 않게
+
+    @app.get("/metrics")
+    def _metrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.get("/healthz")
+    def _healthz():
+        at = _loop_heartbeat["at"]
+        if at is not None and time.monotonic() - at > LIVENESS_MAX_STALL:
+            return Response("event loop stalled\n", status=503, mimetype="text/plain")
+        return Response("ok\n", mimetype="text/plain")
+
+    @app.get("/readyz")
+    def _readyz():
+        if _is_ready():
+            return Response("ready\n", mimetype="text/plain")
+        return Response("starting\n", status=503, mimetype="text/plain")
+
+    try:
+        server = make_server("0.0.0.0", METRICS_PORT, app, threaded=True)
+    except (OSError, SystemExit) as e:
+        # 포트가 이미 쓰이는 중 등 (werkzeug 는 이때 sys.exit 를 부른다): 메트릭 없이 봇은 그대로 띄운다
+        reason = "포트 사용 중" if isinstance(e, SystemExit) else e
+        print(f"⚠️ 메트릭/헬스체크 서버를 띄우지 못했습니다 (:{METRICS_PORT}, {reason}). 봇은 계속 실행합니다.")
+        return
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 메트릭/헬스체크 서버: :{METRICS_PORT} (/metrics, /healthz, /readyz)")
+
+_lag_task = None
+
+# ====== 시작 예열 ======
+# 인증이 끝나면 워크시트 핸들과 읽기 복제본(이름 인덱스 포함)을 동시에 받아 둔 뒤 준비 완료로 표시한다.
+warmup_done = threading.Event()
+_warmup_task = None
+
+async def _warm_guild(cfg: GuildSheets):
+    current_sheets.set(cfg)
+    # 기본 문서는 연결될 때까지, 다른 길드 문서는 잠깐만 기다린다 (인증이 안 되는 길드가 준비 완료를 막지 않게)
+    if not await sheets.wait_ready(cfg.key, None if cfg is DEFAULT_SHEETS else SHEETS_READY_WAIT):
+        return [SheetsNotReady(f"{cfg.key}: 인증 대기 시간 초과")]
+    with bulk_lane():
+        return await asyncio.gather(
+            sheet_io.read(sheet_handles.worksheet, cfg.key, cfg.title("체력값")),  # 모든 워크시트 핸들을 한 번에 캐시
+            sheet_replicas.get(cfg).snapshot(fresh=True),                           # 체력값/명단 이름 인덱스도 함께 채움
+            return_exceptions=True,
+        )
+
+async def _warm_up():
+    t0 = time.perf_counter()
+    per_guild = await asyncio.gather(*(_warm_guild(cfg) for cfg in all_guild_sheets()))
+    for results in per_guild:
+        for r in results:
+            if isinstance(r, Exception):
+                print(f"⚠️ 시작 예열 일부 실패 (명령 시 다시 읽음): {r}")
+    sheet_replicas.start()
+    if hp_ledger is not None:
+        hp_ledger.start()
+    if audit_log is not None:
+        audit_log.start()
+    warmup_done.set()
+    print(f"🚀 준비 완료 (시트 예열 {time.perf_counter() - t0:.1f}초)")
+
 @bot.event
 async def on_ready():
     print(f'✅ Logged in as {bot.user} ({bot.user.id})')
+    global _lag_task, _warmup_task
+    if _lag_task is None or _lag_task.done():
+        _lag_task = asyncio.create_task(_watch_loop_lag())
+    if _warmup_task is None:
+        _warmup_task = asyncio.create_task(_warm_up())
 
 @bot.command(name="접속", help="현재 봇이 정상 작동 중인지 확인합니다. 만약 봇이 응답하지 않으면 접속 오류입니다. 예) !접속")
 async def 접속(ctx):
@@ -94,12 +1269,15 @@ async def 접속(ctx):
     await ctx.send(f"현재 봇이 구동 중입니다.\n{timestamp}")
 
 # ✅ 연결 테스트용 커맨드 (원하면 삭제 가능)
+def _sheet_test_roundtrip():
+    sh = ws("연결 확인")  # '연결 확인' 시트 핸들러
+    sh.update_acell("A1", f"✅ 연결 OK @ {now_kst_str()}")
+    return sh.acell("A1").value
+
 @bot.command(name="시트테스트", help="연결 확인 시트의 A1에 현재 시간을 기록하고 값을 확인합니다. 예) !시트테스트")
 async def 시트테스트(ctx):
     try:
-        sh = ws("연결 확인")  # '연결 확인' 시트 핸들러
-        sh.update_acell("A1", f"✅ 연결 OK @ {now_kst_str()}")
-        val = sh.acell("A1").value
+        val = await sheet_io.write("연결 확인", _sheet_test_roundtrip)
         await ctx.send(f"A1 = {val}")
     except Exception as e:
         await ctx.send(f"❌ 시트 접근 실패: {e}")
@@ -113,15 +1291,15 @@ async def 다이스(ctx):
 # ====== 명령어: !합계 / !구매 / !사용 ======
 
 def ws(title: str):
-    # 같은 문서 내 워크시트 핸들러
-    return gclient.open_by_key(SHEET_KEY).worksheet(title)
+    # 현재 길드 문서의 워크시트 핸들러 (캐시 재사용). title 은 논리 이름
+    cfg = current_sheets.get()
+    return sheet_handles.worksheet(cfg.key, cfg.title(title))
 
-@bot.command(name="합계", help="체력값 시트의 대선(G2), 사련(I2) 값을 불러옵니다. 예) !합계")
-async def 합계(ctx):
+@bot.command(name="합계", help="체력값 시트의 대선(G2), 사련(I2) 값을 불러옵니다. `!합계 최신`은 캐시 없이 바로 읽습니다. 예) !합계")
+async def 합계(ctx, 옵션: str = ""):
     try:
-        sh = ws("체력값")
-        v_g2 = sh.acell("G2").value  # 대선
-        v_i2 = sh.acell("I2").value  # 사련
+        snap = await sheet_replicas.get().snapshot(fresh=(옵션 == "최신"))
+        v_g2, v_i2 = snap.totals
         timestamp = datetime.now(KST).strftime("%Y-%m-%d %H:%M:%S")
         await ctx.send(
             f"현재 대선의 체력값은 '{v_g2}', 사련의 체력값은 '{v_i2}'입니다.\n{timestamp}"
@@ -130,17 +1308,6 @@ async def 합계(ctx):
         timestamp = datetime.now(KST).strftime("%Y-%m-%d %H:%M:%S")
         await ctx.send(f"❌ 조회 실패: {e}\n{timestamp}")
 
-def _find_row_by_name(worksheet, name: str) -> int | None:
-    # '명단' 시트의 B열에서 정확히 일치하는 첫 행 번호 반환 (없으면 None)
-    try:
-        colB = worksheet.col_values(2)  # B열 = index 2
-        for idx, val in enumerate(colB, start=1):
-            if (val or "").strip() == name.strip():
-                return idx
-        return None
-    except Exception:
-        return None
-
 def _normalize_items_str(s: str | None) -> str:
     # 콤마로 구분된 아이템 문자열 정규화 (공백 제거, 빈 토큰 제거)
     if not s:
@@ -209,127 +1376,694 @@ def items_to_cell(order, items):
             out.append(f"{name} {qty}개")
     return ", ".join(out)
 
-def find_row_by_name(sheet, target_name: str, name_col=2):
-    """B열에서 이름 정확 일치 행 찾기 (없으면 None)"""
-    col_vals = sheet.col_values(name_col)
-    tgt = (target_name or "").strip()
-    for idx, val in enumerate(col_vals, start=1):
-        if (val or "").strip() == tgt:
-            return idx
-    return None
+# ===== 인벤토리(명단 F열) =====
+class Inventory:
+    """명단 F열 한 칸의 물품 목록. 입력 순서를 유지하는 dict(이름 → 수량)."""
+    __slots__ = ("counts",)
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    @classmethod
+    def parse(cls, cell_value: str | None) -> "Inventory":
+        with span("parse_items"):
+            order, items = parse_items_cell(cell_value)
+        return cls({n: items[n] for n in order})
+
+    def copy(self) -> "Inventory":
+        return Inventory(self.counts)
+
+    def qty(self, name: str) -> int:
+        return self.counts.get(name, 0)
+
+    def add(self, name: str, qty: int):
+        before = self.qty(name)
+        self.counts[name] = before + qty
+        return before, before + qty
+
+    def remove(self, name: str, qty: int):
+        """0 이하가 되면 목록에서 제거하고 after=0 반환."""
+        before = self.qty(name)
+        after = before - qty
+        if after <= 0:
+            self.counts.pop(name, None)
+            after = 0
+        else:
+            self.counts[name] = after
+        return before, after
+
+    def to_cell(self) -> str:
+        return items_to_cell(list(self.counts), self.counts)
+
+class InventoryCache:
+    """이름별 (F열 원문, 파싱 결과). 원문이 그대로면 다시 파싱하지 않는다."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = {}
+
+    def load(self, name: str, raw: str | None) -> Inventory:
+        raw = raw or ""
+        with self._lock:
+            hit = self._by_name.get(name)
+        if hit and hit[0] == raw:
+            return hit[1].copy()
+        inv = Inventory.parse(raw)
+        self.store(name, raw, inv)
+        return inv.copy()
+
+    def store(self, name: str, raw: str, inv: Inventory):
+        with self._lock:
+            self._by_name[name] = (raw, inv.copy())
+
+inventory_cache = InventoryCache()
+
+def parse_item_list(text: str):
+    """
+    '에너지바 2개, 붕대 3개' → [('에너지바', 2), ('붕대', 3)]
+    같은 아이템이 여러 번 나오면 수량을 합친다 (순서 유지).
+    """
+    merged = {}
+    for chunk in (text or "").split(","):
+        if not chunk.strip():
+            continue
+        name, qty = parse_name_and_qty(chunk)
+        merged[name] = merged.get(name, 0) + qty
+    return list(merged.items())
+
+def _apply_inventory_ops(이름: str, ops, remove: bool = False):
+    """
+    명단 F열에 여러 아이템을 한 번에 추가/차감하고 셀 하나로 쓴다 (전부 적용 또는 전부 취소).
+    반환: (row, changes, missing)
+      - 이름 없음: (None, None, None)
+      - 차감할 아이템이 없음: (row, None, 없는 아이템 이름)
+      - 성공: (row, [(item, qty, before, after), ...], None)
+    """
+    sh = ws("명단")
+    key = (이름 or "").strip()
+    for _ in range(SHEET_CAS_RETRIES):
+        row, values = _locate_row(sh, 이름, 6)  # B열로 찾고 B~F 읽기
+        if not row:
+            return None, None, None
+
+        inv = inventory_cache.load(key, values[4])  # F열
+        if remove:
+            for item_name, _ in ops:
+                if inv.qty(item_name) <= 0:
+                    return row, None, item_name
+
+        changes = []
+        for item_name, qty in ops:
+            before, after = inv.remove(item_name, qty) if remove else inv.add(item_name, qty)
+            changes.append((item_name, qty, before, after))
+        if not SHEET_CAS or _cells_unchanged(sh, {f"F{row}": values[4]}):
+            break
+    else:
+        raise ConcurrentEditError("물품 목록이 계속 다른 곳에서 수정되고 있어 반영하지 못했습니다. 잠시 후 다시 시도하세요.")
+
+    raw = inv.to_cell()
+    sh.update_cell(row, 6, raw)
+    inventory_cache.store(key, raw, inv)
+    return row, changes, None
 
 # ===== !구매 / !사용 =====
-@bot.command(name="구매", help="!구매 이름 아이템 [수] → 명단 시트 F열 물품 수량을 추가합니다. 예) !구매 홍길동 에너지바 2개")
+@bot.command(name="구매", help="!구매 이름 아이템 [수][, 아이템 [수] ...] → 명단 시트 F열 물품 수량을 추가합니다. 예) !구매 홍길동 에너지바 2개, 붕대 3개")
 async def 구매(ctx, 이름: str, *, 아이템문구: str):
     try:
-        sh = ws("명단")
-        row = find_row_by_name(sh, 이름, name_col=2)  # B열
-        if not row:
-            await ctx.send(f"❌ '명단' 시트 B열에서 '{이름}'을 찾지 못했습니다.")
-            return
-
-        item_name, add_qty = parse_name_and_qty(아이템문구)
-        if add_qty <= 0:
+        ops = parse_item_list(아이템문구)
+        if not ops or any(qty <= 0 for _, qty in ops):
             await ctx.send(f"⚠️ 수량은 1 이상이어야 합니다. 예) `!구매 홍길동 에너지바 2개`")
             return
 
-        cell_val = sh.cell(row, 6).value  # F열
-        order, items = parse_items_cell(cell_val)
-
-        # 업데이트
-        if item_name not in items:
-            order.append(item_name)
-            items[item_name] = 0
-        before = items[item_name]
-        items[item_name] += add_qty
-        after = items[item_name]
-
-        sh.update_cell(row, 6, items_to_cell(order, items))
+        row, changes, _ = await sheet_io.write_rows("명단", [이름], 6, _apply_inventory_ops, 이름, ops)
+        if not row:
+            await ctx.send(f"❌ '명단' 시트 B열에서 '{이름}'을 찾지 못했습니다.")
+            return
+        for item_name, _, before, after in changes:
+            _audit(ctx, 이름, item_name, before, after)
 
+        lines = [
+            f"✅ '{이름}'의 '{item_name}' {before}개 → +{qty} = **{after}개**로 업데이트"
+            for item_name, qty, before, after in changes
+        ]
         timestamp = now_kst_str()
-        await ctx.send(f"✅ '{이름}'의 '{item_name}' {before}개 → +{add_qty} = **{after}개**로 업데이트\n{timestamp}")
+        await ctx.send("\n".join(lines) + f"\n{timestamp}")
 
     except Exception as e:
         await ctx.send(f"❌ 구매 처리 실패: {e}")
 
-@bot.command(name="사용", help="!사용 이름 아이템 [수] → 명단 시트 F열 물품 수량을 감소합니다. 예) !사용 홍길동 에너지바 2개")
+@bot.command(name="사용", help="!사용 이름 아이템 [수][, 아이템 [수] ...] → 명단 시트 F열 물품 수량을 감소합니다. 예) !사용 홍길동 에너지바 2개, 붕대 1개")
 async def 사용(ctx, 이름: str, *, 아이템문구: str):
     try:
-        sh = ws("명단")
-        row = find_row_by_name(sh, 이름, name_col=2)  # B열
-        if not row:
-            await ctx.send(f"❌ '명단' 시트 B열에서 '{이름}'을 찾지 못했습니다.")
-            return
-
-        item_name, sub_qty = parse_name_and_qty(아이템문구)
-        if sub_qty <= 0:
+        ops = parse_item_list(아이템문구)
+        if not ops or any(qty <= 0 for _, qty in ops):
             await ctx.send(f"⚠️ 수량은 1 이상이어야 합니다. 예) `!사용 홍길동 에너지바 2개`")
             return
 
-        cell_val = sh.cell(row, 6).value  # F열
-        order, items = parse_items_cell(cell_val)
-
-        if item_name not in items or items[item_name] <= 0:
-            await ctx.send(f"⚠️ '{이름}'에게 '{item_name}'가 없습니다.")
+        row, changes, missing = await sheet_io.write_rows("명단", [이름], 6, _apply_inventory_ops, 이름, ops, remove=True)
+        if not row:
+            await ctx.send(f"❌ '명단' 시트 B열에서 '{이름}'을 찾지 못했습니다.")
             return
+        if missing:
+            await ctx.send(f"⚠️ '{이름}'에게 '{missing}'가 없습니다.")
+            return
+        for item_name, _, before, after in changes:
+            _audit(ctx, 이름, item_name, before, after)
 
-        before = items[item_name]
-        after = before - sub_qty
-        if after <= 0:
-            # 0 이하는 삭제
-            items[item_name] = 0
-            # order에서 완전히 제거할지 유지할지 선택: 여기선 제거
-            order = [n for n in order if n != item_name]
-            msg_change = f"{before}개 → -{sub_qty} = **0개** (목록에서 제거)"
-        else:
-            items[item_name] = after
-            msg_change = f"{before}개 → -{sub_qty} = **{after}개**"
-
-        sh.update_cell(row, 6, items_to_cell(order, items))
-
+        lines = []
+        for item_name, qty, before, after in changes:
+            if after <= 0:
+                msg_change = f"{before}개 → -{qty} = **0개** (목록에서 제거)"
+            else:
+                msg_change = f"{before}개 → -{qty} = **{after}개**"
+            lines.append(f"✅ '{이름}'의 '{item_name}' 사용 처리: {msg_change}")
         timestamp = now_kst_str()
-        await ctx.send(f"✅ '{이름}'의 '{item_name}' 사용 처리: {msg_change}\n{timestamp}")
+        await ctx.send("\n".join(lines) + f"\n{timestamp}")
 
     except Exception as e:
         await ctx.send(f"❌ 사용 처리 실패: {e}")
 
-def _find_row_in_colB(sh, name: str):
-    """B열에서 이름 정확 일치 행 번호 반환 (없으면 None)"""
-    colB = sh.col_values(2)
-    target = (name or "").strip()
-    for idx, val in enumerate(colB, start=1):
-        if (val or "").strip() == target:
-            return idx
-    return None
-
-def _read_hp_D(sh, row: int) -> int:
-    """해당 행의 D열(체력값) 정수 읽기 (비정상/공백은 0)"""
-    raw = (sh.cell(row, 4).value or "0").strip()
+def _parse_hp(raw) -> int:
+    """D열(체력값) 문자열 → 정수 (비정상/공백은 0)"""
     try:
-        return int(raw)
+        return int((raw or "0").strip())
     except ValueError:
         return 0
 
-def _write_hp_D(sh, row: int, value: int):
-    """해당 행의 D열 값 쓰기"""
-    sh.update_cell(row, 4, value)
+def _apply_delta_to_hp_many(names, delta: int):
+    """
+    '체력값' 시트에서 여러 이름(B열)의 D열에 delta 를 한 번에 반영.
+    읽기는 batch_get 한 번, 쓰기는 batch_update 한 번 (대상 수와 무관하게 일정한 요청 수).
+    반환: [(name, row, cur_val, new_val), ...] 입력 순서 유지, 못 찾으면 row 이하 None
+    """
+    sh = ws("체력값")
+    for _ in range(SHEET_CAS_RETRIES):
+        found = _locate_rows(sh, names, 4)  # B열로 찾고 B~D 읽기
+        results, updates, expected = [], [], {}
+        for name in names:
+            hit = found.get((name or "").strip())
+            if not hit:
+                results.append((name, None, None, None))
+                continue
+            row, values = hit
+            cur_val = _parse_hp(values[2])
+            new_val = cur_val + delta
+            updates.append({"range": f"D{row}", "values": [[new_val]]})
+            expected[f"D{row}"] = values[2]
+            results.append((name, row, cur_val, new_val))
+        if not updates or not SHEET_CAS or _cells_unchanged(sh, expected):
+            break
+    else:
+        raise ConcurrentEditError("체력값이 계속 다른 곳에서 수정되고 있어 반영하지 못했습니다. 잠시 후 다시 시도하세요.")
+    if updates:
+        sh.batch_update(updates, value_input_option="USER_ENTERED")
+    return results
+
+# ====== 체력 지연 쓰기(write-behind) 장부 ======
+# HP_WRITE_BEHIND=1 이면 !추가/!차감을 바로 시트에 쓰지 않고 이름별 delta 로 모아 둔다.
+# - 응답은 (마지막으로 확인한 시트 값 + 대기 중 delta) 로 즉시
+# - 주기(HP_FLUSH_INTERVAL) 또는 대기 인원(HP_FLUSH_THRESHOLD) 도달 시 batch 한 번으로 반영
+# - 대기 delta 는 로컬 SQLite(WAL) 에 먼저 기록 → 재시작/크래시 후 재생
+HP_WRITE_BEHIND = os.getenv("HP_WRITE_BEHIND", "0") == "1"
+if HP_WRITE_BEHIND and MULTI_PROCESS:
+    # 대기 delta 가 워커마다 따로 쌓여 응답 값이 어긋나므로 다중 워커에서는 바로 쓰기로
+    print("⚠️ 다중 워커 모드에서는 HP_WRITE_BEHIND 를 쓰지 않습니다.")
+    HP_WRITE_BEHIND = False
+HP_JOURNAL_PATH = os.getenv("HP_JOURNAL_PATH", "hp_journal.sqlite3")
+HP_FLUSH_INTERVAL = float(os.getenv("HP_FLUSH_INTERVAL", "5"))
+HP_FLUSH_THRESHOLD = int(os.getenv("HP_FLUSH_THRESHOLD", "20"))
+
+HP_BASE_TTL = float(os.getenv("HP_BASE_TTL", "30"))  # 이보다 오래된 기준값은 다시 읽는다 (시트 직접 편집 반영)
+
+def _write_hp_values(sh, targets: dict):
+    if targets:
+        sh.batch_update(
+            [{"range": f"D{row}", "values": [[value]]} for row, value in targets.values()],
+            value_input_option="USER_ENTERED",
+        )
 
-def _apply_delta_to_hp(name: str, delta: int):
+def _flush_hp_deltas(deltas: dict, save_plan):
     """
-    '체력값' 시트에서 이름(B열) 찾아, 같은 행 D열에 delta만큼 반영.
-    반환: (row, cur_val, new_val)
+    {이름: delta} 를 현재 시트 값에 더한 목표값을 계산해 save_plan 으로 저널에 먼저 남기고, 한 번에 쓴다.
+    목표값(절대값)을 남겨 두므로 쓰기 결과를 모른 채 끝나도 같은 값을 다시 쓰면 되고 delta 가 두 번 더해지지 않는다.
+    반환: ({이름: (row, 쓴 값)}, 시트에 없는 이름 목록)
     """
     sh = ws("체력값")
-    row = _find_row_in_colB(sh, name)
-    if not row:
-        return None, None, None
-    cur_val = _read_hp_D(sh, row)
-    new_val = cur_val + delta
-    _write_hp_D(sh, row, new_val)
-    return row, cur_val, new_val
-
-@bot.command(name="추첨", help="!추첨 숫자 → 체력값 시트 B6부터 마지막 행까지 이름 중에서 숫자만큼 무작위 추첨합니다. 예) !추첨 3")
-async def 추첨(ctx, 숫자: str):
+    found = _locate_rows(sh, list(deltas), 4)
+    targets = {}
+    for name, delta in deltas.items():
+        hit = found.get(name)
+        if hit:
+            row, values = hit
+            targets[name] = (row, _parse_hp(values[2]) + delta)
+    save_plan({name: value for name, (_, value) in targets.items()})
+    _write_hp_values(sh, targets)
+    return targets, [n for n in deltas if n not in targets]
+
+def _replay_hp_values(values: dict):
+    """저널에 남은 목표값 {이름: 값} 을 다시 쓴다 (행이 밀렸을 수 있어 행은 새로 찾음)."""
+    sh = ws("체력값")
+    found = _locate_rows(sh, list(values), 4)
+    targets = {name: (found[name][0], value) for name, value in values.items() if name in found}
+    _write_hp_values(sh, targets)
+    return targets
+
+class HpLedger:
+    def __init__(self, journal_path: str, interval: float, threshold: int):
+        self._interval = interval
+        self._threshold = threshold
+        self._base = {}     # 이름 -> (row, 마지막으로 확인한 시트 값, 확인 시각)
+        self._pending = {}  # 이름 -> 아직 시트에 반영되지 않은 delta 합 (_applied_upto 이후분)
+        self._planned = {}  # 이름 -> 쓰다 만 목표값 (시트에 들어갔는지 모름)
+        self._applied_upto = 0  # _planned 에 이미 포함된 hp_pending id 상한
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._db_lock = threading.Lock()  # 목표값 기록은 시트 I/O 스레드에서 한다
+        self._db = sqlite3.connect(journal_path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hp_pending ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, delta INTEGER NOT NULL, at TEXT NOT NULL)"
+        )
+        # 시트에 쓰기 직전의 목표값. upto 이하의 hp_pending 을 반영한 결과이며, 반영이 확인되면 함께 지운다.
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hp_flush (name TEXT PRIMARY KEY, value INTEGER NOT NULL, upto INTEGER NOT NULL)"
+        )
+        # 이전 실행에서 반영되지 못한 delta / 목표값 복구
+        self._adopt_plan()
+        if self._pending or self._planned:
+            print(f"♻️ 미반영 체력 변경 {len(self._pending) + len(self._planned)}건을 저널에서 복구했습니다.")
+
+    def _reload_pending(self):
+        with self._db_lock:
+            self._pending = dict(self._db.execute(
+                "SELECT name, SUM(delta) FROM hp_pending WHERE id > ? GROUP BY name", (self._applied_upto,)
+            ))
+
+    def _adopt_plan(self):
+        """
+        저널에 남은 목표값을 기준값으로 삼는다. 시트 반영 여부를 모르므로 시트 값 대신 목표값을 쓰고,
+        목표값에 이미 들어간 upto 이하 delta 는 대기열에서 뺀다 (다음 flush 가 목표값을 다시 쓴다).
+        """
+        plan = self._saved_plan()
+        self._planned, self._applied_upto = plan if plan is not None else ({}, 0)
+        for name in self._planned:
+            self._base.pop(name, None)
+        self._reload_pending()
+
+    def _save_plan(self, upto: int, values: dict):
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM hp_flush")
+            self._db.executemany(
+                "INSERT INTO hp_flush (name, value, upto) VALUES (?, ?, ?)", [(n, v, upto) for n, v in values.items()]
+            )
+            self._db.execute("COMMIT")
+
+    def _saved_plan(self):
+        with self._db_lock:
+            rows = self._db.execute("SELECT name, value, upto FROM hp_flush").fetchall()
+        if not rows:
+            return None
+        return {name: value for name, value, _ in rows}, rows[0][2]
+
+    def _commit(self, upto: int, written: dict, names):
+        """upto 까지의 delta 가 시트에 들어갔음을 기록하고 대기열/기준값을 맞춘다."""
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM hp_pending WHERE id <= ?", (upto,))
+            self._db.execute("DELETE FROM hp_flush")
+            self._db.execute("COMMIT")
+        self._planned, self._applied_upto = {}, 0
+        self._reload_pending()
+        now = time.monotonic()
+        for name in names:
+            if name in written:
+                row, value = written[name]
+                self._base[name] = (row, value, now)
+            else:
+                self._base.pop(name, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        sheet_lane.set(LANE_BULK)  # 백그라운드 반영은 대량 작업 우선순위
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print("❌ 체력 변경 반영 실패 (다음 주기에 재시도):", e)
+
+    async def apply(self, names, delta: int):
+        """
+        _apply_delta_to_hp_many 와 같은 형태로 결과를 돌려주되 시트 쓰기는 미룬다.
+        처음 보거나 HP_BASE_TTL 이 지난 이름만 batch_get 한 번으로 현재 값을 읽어 온다.
+        """
+        keys = [(n or "").strip() for n in names]
+        now = time.monotonic()
+        unknown = list(dict.fromkeys(
+            k for k in keys if k not in self._base or now - self._base[k][2] >= HP_BASE_TTL
+        ))
+        if unknown:
+            async with self._flush_lock:  # 반영 도중에 읽으면 시트 값과 대기 delta 가 겹쳐 보인다
+                found = await sheet_io.read(lambda: _locate_rows(ws("체력값"), unknown, 4))
+            now = time.monotonic()
+            for k in unknown:
+                if k in found:
+                    row, values = found[k]
+                    self._base[k] = (row, self._planned.get(k, _parse_hp(values[2])), now)
+                else:
+                    self._base.pop(k, None)
+
+        results, journal, stamp = [], [], now_kst_str()
+        for name, k in zip(names, keys):
+            if k not in self._base:
+                results.append((name, None, None, None))
+                continue
+            row, base, _ = self._base[k]
+            cur_val = base + self._pending.get(k, 0)
+            journal.append((k, delta, stamp))
+            self._pending[k] = self._pending.get(k, 0) + delta
+            results.append((name, row, cur_val, cur_val + delta))
+
+        # 이벤트 루프에서 바로 기록한다: WAL + synchronous=NORMAL 이라 fsync 없는 로컬 트랜잭션 한 번이고,
+        # 같은 잠금을 잡는 시트 I/O 스레드(_save_plan)도 잠금 안에서는 SQLite 만 만지므로 네트워크를 기다릴 일이 없다.
+        # 스레드로 넘기면 그 사이 _commit 의 _reload_pending 과 순서가 꼬여 delta 가 두 번 잡힐 수 있다.
+        if journal:
+            with self._db_lock:
+                self._db.executemany("INSERT INTO hp_pending (name, delta, at) VALUES (?, ?, ?)", journal)
+
+        if len(self._pending) >= self._threshold:
+            self._wake.set()
+        return results
+
+    async def flush(self):
+        """
+        대기 중 delta 를 묶어 시트에 반영. 목표값을 저널에 먼저 남기고 쓰며,
+        이전에 쓰다 만(결과를 모르는) 목표값이 남아 있으면 그것부터 그대로 다시 쓴다.
+        """
+        async with self._flush_lock:
+            plan = self._saved_plan()
+            if plan is not None:
+                values, upto = plan
+                written = await sheet_io.write("체력값", _replay_hp_values, values)
+                self._commit(upto, written, values)
+
+            with self._db_lock:
+                (upto,) = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM hp_pending").fetchone()
+                deltas = dict(self._db.execute(
+                    "SELECT name, SUM(delta) FROM hp_pending WHERE id <= ? GROUP BY name", (upto,)
+                ))
+            if not deltas:
+                return
+            try:
+                written, missing = await sheet_io.write(
+                    "체력값", _flush_hp_deltas, deltas, functools.partial(self._save_plan, upto)
+                )
+            except Exception:
+                self._adopt_plan()  # 쓰다 실패했으면 시트 값을 다시 읽어도 믿을 수 없다
+                raise
+            for name in missing:
+                print(f"⚠️ '{name}'을(를) 체력값 시트에서 찾지 못해 대기 중 변경({deltas[name]:+d})을 버립니다.")
+            self._commit(upto, written, deltas)
+
+    def invalidate(self):
+        """시트 값이 외부에서 바뀌었을 때(!전체 등) 캐시된 기준값을 버린다. 대기 delta 는 유지."""
+        self._base.clear()
+
+hp_ledger = HpLedger(HP_JOURNAL_PATH, HP_FLUSH_INTERVAL, HP_FLUSH_THRESHOLD) if HP_WRITE_BEHIND else None
+
+def _hp_ledger():
+    """지연 쓰기 장부는 기본 문서에만 쓴다 (저널에 문서 구분이 없음). 다른 길드는 바로 반영."""
+    return hp_ledger if current_sheets.get() is DEFAULT_SHEETS else None
+
+async def _adjust_hp(names, delta: int):
+    """!추가/!차감 공통: 지연 쓰기 모드면 장부에, 아니면 바로 시트에 반영."""
+    ledger = _hp_ledger()
+    if ledger is not None:
+        return await ledger.apply(names, delta)
+    return await sheet_io.write_rows("체력값", names, 4, _apply_delta_to_hp_many, names, delta)
+
+# ====== 변경 감사 로그 ======
+# 체력/물품을 바꾼 명령마다 (시각, 수정자, 명령, 대상, 항목, 이전, 이후) 를 남긴다.
+# - 로컬 파일(JSON Lines)에는 즉시 덧붙이고, 시트에는 메모리에 모았다가 append_rows 한 번으로 묶어서 쓴다
+# - 명령 처리 중에는 시트 요청을 보내지 않는다 (주기 AUDIT_FLUSH_INTERVAL, 대기 AUDIT_FLUSH_ROWS 건 도달 시 반영)
+# - 시트 반영이 계속 실패하면 대기열은 AUDIT_MAX_PENDING 건까지만 들고 오래된 것부터 버린다 (로컬 파일에는 남음)
+AUDIT_LOG = os.getenv("AUDIT_LOG", "1") == "1"
+AUDIT_SHEET_TITLE = os.getenv("AUDIT_SHEET_TITLE", "감사로그")
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH", "audit_log.jsonl")
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "10"))
+AUDIT_FLUSH_ROWS = int(os.getenv("AUDIT_FLUSH_ROWS", "200"))
+AUDIT_BATCH_ROWS = 1000  # append_rows 한 번에 보내는 최대 행 수
+AUDIT_MAX_PENDING = int(os.getenv("AUDIT_MAX_PENDING", "20000"))
+AUDIT_HEADER = ["시각", "수정자", "명령", "대상", "항목", "이전", "이후"]
+
+def _append_audit_rows(cfg: GuildSheets, rows: list[list[str]]):
+    title = cfg.title(AUDIT_SHEET_TITLE)
+    try:
+        sh = sheet_handles.worksheet(cfg.key, title)
+    except gspread.exceptions.WorksheetNotFound:
+        book = sheet_handles.spreadsheet(cfg.key)
+        sh = book.add_worksheet(title=title, rows=1, cols=len(AUDIT_HEADER))
+        sheet_handles.invalidate(cfg.key)
+        rows = [AUDIT_HEADER] + rows
+    # RAW: 이름/아이템 문자열이 수식으로 해석되지 않게
+    sh.append_rows(rows, value_input_option="RAW", table_range="A1")
+
+def _audit_rows_present(cfg: GuildSheets, rows: list[list[str]]) -> bool:
+    """결과를 모르는 append 뒤: 시트 마지막 행들이 rows 와 같으면 이미 반영된 것으로 본다."""
+    title = cfg.title(AUDIT_SHEET_TITLE)
+    sheet_handles.invalidate(cfg.key, title)  # 행 수(row_count)를 새 메타데이터로
+    try:
+        sh = sheet_handles.worksheet(cfg.key, title)
+    except gspread.exceptions.WorksheetNotFound:
+        return False
+    last = sh.row_count
+    if last < len(rows):
+        return False
+    got = sh.get(f"A{last - len(rows) + 1}:{_col_letter(len(AUDIT_HEADER))}{last}")
+
+    def norm(row):
+        row = [str(v) for v in row]
+        while row and row[-1] == "":
+            row.pop()
+        return row
+
+    return [norm(r) for r in got] == [norm(r) for r in rows]
+
+def _append_maybe_applied(e: Exception) -> bool:
+    """4xx 는 반영 전 거절, 그 밖(5xx/타임아웃/연결 끊김)은 서버에 들어갔을 수도 있다."""
+    return not (isinstance(e, gspread.exceptions.APIError) and e.response.status_code < 500)
+
+class AuditLog:
+    def __init__(self, path: str, interval: float, threshold: int, max_pending: int):
+        self._interval = interval
+        self._threshold = threshold
+        self._max_pending = max_pending
+        self._pending = collections.deque()  # (길드 설정, 행)
+        self._uncertain = {}  # 길드 설정 -> 결과를 모르는 채 끝난 마지막 append 의 행들
+        self.dropped = 0
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._file = open(path, "a", encoding="utf-8", buffering=1)  # 줄 단위로 바로 기록
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        sheet_lane.set(LANE_BULK)  # 백그라운드 반영은 대량 작업 우선순위
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ 감사 로그 시트 반영 실패 (다음 주기에 재시도, 대기 {len(self._pending)}건):", e)
+
+    def record(self, ctx, target: str, field: str, before, after):
+        actor = getattr(ctx.author, "display_name", str(ctx.author))
+        command = getattr(ctx.command, "qualified_name", None) or current_command.get()
+        cfg = current_sheets.get()
+        row = [now_kst_str(), actor, command, target, field, "" if before is None else str(before), "" if after is None else str(after)]
+        self._file.write(json.dumps({"문서": cfg.key, **dict(zip(AUDIT_HEADER, row))}, ensure_ascii=False) + "\n")
+        if len(self._pending) >= self._max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((cfg, row))
+        if len(self._pending) >= self._threshold:
+            self._wake.set()
+
+    async def flush(self):
+        """
+        대기 중 기록을 AUDIT_BATCH_ROWS 씩, 문서별 append_rows 한 번으로 덧붙인다.
+        실패한 문서의 행만 대기열 앞으로 되돌리고 다른 문서는 계속 반영한다.
+        """
+        async with self._flush_lock:
+            # 직전 append 가 실제로 들어갔으면 그 행들은 다시 붙이지 않는다 (중복 방지)
+            for cfg, rows in list(self._uncertain.items()):
+                applied = await sheet_io.read(_audit_rows_present, cfg, rows)
+                del self._uncertain[cfg]
+                if applied:
+                    done = {id(r) for r in rows}
+                    self._pending = collections.deque(item for item in self._pending if id(item[1]) not in done)
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(AUDIT_BATCH_ROWS, len(self._pending)))]
+                groups = {}
+                for cfg, row in batch:
+                    groups.setdefault(cfg, []).append(row)
+                failed, error = set(), None
+                for cfg, rows in groups.items():
+                    try:
+                        await sheet_io.read(_append_audit_rows, cfg, rows)
+                    except Exception as e:
+                        failed.add(cfg)
+                        error = e
+                        if _append_maybe_applied(e):
+                            self._uncertain[cfg] = rows
+                if error is not None:
+                    self._pending.extendleft(reversed([item for item in batch if item[0] in failed]))
+                    raise error
+
+    def __len__(self):
+        return len(self._pending)
+
+audit_log = AuditLog(AUDIT_LOG_PATH, AUDIT_FLUSH_INTERVAL, AUDIT_FLUSH_ROWS, AUDIT_MAX_PENDING) if AUDIT_LOG else None
+
+def _audit(ctx, target: str, field: str, before, after):
+    if audit_log is not None:
+        audit_log.record(ctx, target, field, before, after)
+
+def _audit_hp(ctx, results):
+    for 이름, row, cur_val, new_val in results:
+        if row is not None:
+            _audit(ctx, 이름, "체력값", cur_val, new_val)
+
+# ====== 추첨 후보 캐시 ======
+# 후보(B6~ 이름)와 가중치 누적 인덱스는 읽기 복제본이 바뀔 때만 다시 만든다.
+# 복제본이 새로 읽혀도 이름/가중치가 그대로면 이전 것을 재사용한다.
+DRAW_FIRST_ROW = 6
+DRAW_COL_RE = re.compile(r"^[A-Z]{1,2}$")
+
+class FenwickSampler:
+    """가중치 누적 인덱스(Fenwick tree). 비복원 추출 한 번에 O(log n), 뽑은 항목은 끝나면 되돌린다."""
+    __slots__ = ("weights", "tree", "total", "_top")
+
+    def __init__(self, weights: list[float]):
+        n = len(weights)
+        tree = [0.0] * (n + 1)
+        for i, w in enumerate(weights, 1):
+            tree[i] += w
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.weights = weights
+        self.tree = tree
+        self.total = sum(weights)
+        self._top = 1 << (n.bit_length() - 1) if n else 0
+
+    def _add(self, i: int, delta: float):
+        i += 1
+        n = len(self.weights)
+        while i <= n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _find(self, target: float) -> int:
+        """누적합이 target 을 처음 넘는 위치 (0부터)."""
+        pos, bit, tree, n = 0, self._top, self.tree, len(self.weights)
+        while bit:
+            nxt = pos + bit
+            if nxt <= n and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            bit >>= 1
+        return min(pos, n - 1)
+
+    def sample(self, k: int, rng=random) -> list[int]:
+        picked, seen = [], set()
+        remaining = self.total
+        try:
+            while len(picked) < k:
+                idx = self._find(rng.random() * remaining)
+                if idx in seen or self.weights[idx] <= 0:
+                    continue  # 부동소수 오차로 이미 뺀 자리를 가리킨 경우
+                seen.add(idx)
+                picked.append(idx)
+                self._add(idx, -self.weights[idx])
+                remaining -= self.weights[idx]
+        finally:
+            for idx in picked:
+                self._add(idx, self.weights[idx])
+        return picked
+
+class DrawPool:
+    __slots__ = ("names", "sampler", "fingerprint")
+
+    def __init__(self, names, sampler, fingerprint):
+        self.names = names
+        self.sampler = sampler  # 균등 추첨이면 None
+        self.fingerprint = fingerprint
+
+def _parse_weight(v) -> float:
+    try:
+        w = float(str(v).replace(",", "").strip())
+    except ValueError:
+        return 0.0
+    return w if w > 0 and w != float("inf") else 0.0
+
+def _read_draw_column(col: str) -> list[str]:
+    sh = ws("체력값")
+    rows = coalesced_read(sh, "get", f"{col}{DRAW_FIRST_ROW}:{col}")
+    return [r[0] if r else "" for r in rows]
+
+class DrawPoolCache:
+    def __init__(self):
+        self._pools = {}  # (문서, 가중치 열(None=균등)) -> (스냅샷, DrawPool)
+
+    async def get(self, snap: SheetSnapshot, col: str | None) -> DrawPool:
+        key = (current_sheets.get().key, col)
+        hit = self._pools.get(key)
+        if hit is not None and hit[0] is snap:
+            return hit[1]
+        names = [r[0].strip() for r in snap.hp[DRAW_FIRST_ROW - 1:]]
+        if col is None:
+            raw = None
+        elif col in ("C", "D"):  # 복제본에 이미 있는 열
+            raw = [r[ord(col) - ord("B")] for r in snap.hp[DRAW_FIRST_ROW - 1:]]
+        else:
+            raw = await sheet_io.read(_read_draw_column, col)
+        fingerprint = hash((tuple(names), tuple(raw) if raw is not None else None))
+        pool = hit[1] if hit is not None and hit[1].fingerprint == fingerprint else self._build(names, raw, fingerprint)
+        self._pools[key] = (snap, pool)
+        return pool
+
+    @staticmethod
+    def _build(names, raw, fingerprint) -> DrawPool:
+        if raw is None:
+            return DrawPool([n for n in names if n], None, fingerprint)
+        raw = list(raw) + [""] * (len(names) - len(raw))
+        pairs = [(n, _parse_weight(w)) for n, w in zip(names, raw)]
+        pairs = [(n, w) for n, w in pairs if n and w > 0]
+        return DrawPool([n for n, _ in pairs], FenwickSampler([w for _, w in pairs]), fingerprint)
+
+draw_pools = DrawPoolCache()
+
+@bot.command(name="추첨", help="!추첨 숫자 [가중치열] → 체력값 시트 B6부터 마지막 행까지 이름 중에서 숫자만큼 무작위 추첨합니다. 열을 주면 그 열의 숫자를 가중치로 씁니다. 예) !추첨 3, !추첨 3 D")
+async def 추첨(ctx, 숫자: str, 가중치열: str = ""):
     if not 숫자.isdigit():
         await ctx.send(f"⚠️ 숫자를 입력하세요. 예) `!추첨 3`")
         return
@@ -339,26 +2073,37 @@ async def 추첨(ctx, 숫자: str):
         await ctx.send(f"⚠️ 1 이상의 숫자를 입력하세요. 예) `!추첨 1`")
         return
 
+    col = 가중치열.strip().upper().rstrip("열") or None
+    if col is not None and (not DRAW_COL_RE.match(col) or col == "B"):
+        await ctx.send(f"⚠️ 가중치 열은 B가 아닌 열 문자로 입력하세요. 예) `!추첨 3 D`")
+        return
+
     try:
-        sh = ws("체력값")
-        colB = sh.col_values(2)  # B열 전체
-        if len(colB) < 6:
+        snap = await sheet_replicas.get().snapshot()
+        if len(snap.hp) < DRAW_FIRST_ROW:
             await ctx.send(f"⚠️ B6 이후 이름 데이터가 없습니다.")
             return
 
-        # B6부터 끝까지, 비어있지 않은 이름만 수집
-        candidates = [v.strip() for v in colB[5:] if v and v.strip()]
-        total = len(candidates)
+        pool = await draw_pools.get(snap, col)
+        total = len(pool.names)
         if total == 0:
-            await ctx.send(f"⚠️ 추첨 대상이 없습니다. (B6 이후가 비어 있음)")
+            if col is None:
+                await ctx.send(f"⚠️ 추첨 대상이 없습니다. (B6 이후가 비어 있음)")
+            else:
+                await ctx.send(f"⚠️ 추첨 대상이 없습니다. ({col}열에 0보다 큰 숫자가 있는 이름이 없음)")
             return
         if k > total:
             await ctx.send(f"⚠️ 추첨 인원이 대상 수({total}명)를 초과합니다. 더 작은 숫자를 입력하세요.")
             return
 
-        winners = random.sample(candidates, k)
+        if pool.sampler is None:
+            winners = random.sample(pool.names, k)
+            label = f"{k}명"
+        else:
+            winners = [pool.names[i] for i in pool.sampler.sample(k)]
+            label = f"{k}명, {col}열 가중치"
         timestamp = now_kst_str()
-        await ctx.send(f"추첨 결과 ({k}명): {', '.join(winners)}\n{timestamp}")
+        await ctx.send(f"추첨 결과 ({label}): {', '.join(winners)}\n{timestamp}")
 
     except Exception as e:
         await ctx.send(f"❌ 추첨 실패: {e}")
@@ -430,8 +2175,15 @@ async def 추가(ctx, *args):
 
     ok_lines = []
     fail_lines = []
-    for 이름 in names:
-        row, cur_val, new_val = _apply_delta_to_hp(이름, delta)
+    try:
+        results = await _adjust_hp(names, delta)
+    except SheetsNotReady:
+        raise  # on_command_error 의 ⏳ 안내
+    except Exception as e:  # 동시 수정 재시도 초과, 시트 API 오류, 워커 간 락 대기 초과 등
+        await ctx.send(f"❌ 체력 추가 실패: {e}\n{timestamp}")
+        return
+    _audit_hp(ctx, results)
+    for 이름, row, cur_val, new_val in results:
         if row is None:
             fail_lines.append(f"❌ '{이름}'을(를) 찾지 못했습니다.")
         else:
@@ -459,8 +2211,15 @@ async def 차감(ctx, *args):
 
     ok_lines = []
     fail_lines = []
-    for 이름 in names:
-        row, cur_val, new_val = _apply_delta_to_hp(이름, delta)
+    try:
+        results = await _adjust_hp(names, delta)
+    except SheetsNotReady:
+        raise  # on_command_error 의 ⏳ 안내
+    except Exception as e:  # 동시 수정 재시도 초과, 시트 API 오류, 워커 간 락 대기 초과 등
+        await ctx.send(f"❌ 체력 차감 실패: {e}\n{timestamp}")
+        return
+    _audit_hp(ctx, results)
+    for 이름, row, cur_val, new_val in results:
         if row is None:
             fail_lines.append(f"❌ '{이름}'을(를) 찾지 못했습니다.")
         else:
@@ -474,6 +2233,157 @@ async def 차감(ctx, *args):
     parts.append(timestamp)
     await ctx.send(f"\n".join(parts))
 
+# ====== !일괄: 여러 변경을 검사 후 한 번에 반영 ======
+# 줄마다 기존 명령 하나 (추가/차감/구매/사용). 이름을 먼저 모두 확인하고, 체력값(D열)/물품(F열) 새 값을
+# 메모리에서 순서대로 계산한 뒤 values_batch_update 한 번으로 쓴다. 문제가 하나라도 있으면 아무것도 쓰지 않는다.
+BATCH_HP_OPS = ("추가", "차감")
+BATCH_ITEM_OPS = ("구매", "사용")
+BATCH_MAX_LINES = int(os.getenv("BATCH_MAX_LINES", "50"))
+
+def _parse_batch_script(text: str):
+    """
+    '추가 이름1 [이름2 ...] 수치' / '차감 ...' / '구매 이름 아이템 [수], ...' / '사용 ...' 를 줄마다 읽는다 ('!' 는 있어도 됨).
+    반환: ([(줄 번호, 명령, [이름, ...], 체력 delta 또는 [(아이템, 수), ...]), ...], None) 또는 (None, 오류 메시지)
+    """
+    ops = []
+    for no, line in enumerate((text or "").splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        op, _, rest = line.lstrip("!").partition(" ")
+        if op in BATCH_HP_OPS:
+            parsed, err = _parse_names_and_amount(rest.split())
+            if err:
+                return None, f"⚠️ {no}번째 줄: {err}"
+            names, amount = parsed
+            ops.append((no, op, names, amount if op == "추가" else -amount))
+        elif op in BATCH_ITEM_OPS:
+            name, _, item_text = rest.strip().partition(" ")
+            items = parse_item_list(item_text)
+            if not name or not items or any(qty <= 0 for _, qty in items):
+                return None, f"⚠️ {no}번째 줄: 이름과 수량 1 이상의 아이템이 필요합니다. 예) `{op} 홍길동 붕대 2개`"
+            ops.append((no, op, [name], items))
+        else:
+            return None, f"⚠️ {no}번째 줄: '{op}'은(는) 일괄 처리할 수 없습니다. (추가/차감/구매/사용)"
+    if not ops:
+        return None, "⚠️ 처리할 줄이 없습니다. 예) `!일괄` 다음 줄부터 `추가 홍길동 5`"
+    if len(ops) > BATCH_MAX_LINES:
+        return None, f"⚠️ 한 번에 최대 {BATCH_MAX_LINES}줄까지 처리할 수 있습니다."
+    return ops, None
+
+def _batch_names(ops):
+    """(체력값 대상 이름, 명단 대상 이름) — 중복 제거, 처음 나온 순서."""
+    hp = dict.fromkeys(n.strip() for _, op, names, _ in ops if op in BATCH_HP_OPS for n in names)
+    roster = dict.fromkeys(n.strip() for _, op, names, _ in ops if op in BATCH_ITEM_OPS for n in names)
+    return list(hp), list(roster)
+
+def _apply_batch(ops):
+    """
+    반환: (결과, None) 또는 (None, 문제 목록) — 문제가 있으면 시트에 아무것도 쓰지 않는다.
+    결과: [(줄 번호, 명령, 이름, 항목, 변화량, 이전, 이후), ...] 입력 순서
+    """
+    hp_names, roster_names = _batch_names(ops)
+    hp_sh = ws("체력값") if hp_names else None
+    roster_sh = ws("명단") if roster_names else None
+    for _ in range(SHEET_CAS_RETRIES):
+        hp_found = _locate_rows(hp_sh, hp_names, 4) if hp_names else {}          # B~D
+        roster_found = _locate_rows(roster_sh, roster_names, 6) if roster_names else {}  # B~F
+        problems = [f"❌ '체력값' 시트 B열에서 '{n}'을(를) 찾지 못했습니다." for n in hp_names if n not in hp_found]
+        problems += [f"❌ '명단' 시트 B열에서 '{n}'을(를) 찾지 못했습니다." for n in roster_names if n not in roster_found]
+        if problems:
+            return None, problems
+
+        hp = {n: _parse_hp(values[2]) for n, (_, values) in hp_found.items()}
+        invs = {n: inventory_cache.load(n, values[4]) for n, (_, values) in roster_found.items()}
+        results = []
+        for no, op, names, arg in ops:
+            if op in BATCH_HP_OPS:
+                for n in names:
+                    n = n.strip()
+                    before = hp[n]
+                    hp[n] = before + arg
+                    results.append((no, op, n, "체력값", arg, before, hp[n]))
+                continue
+            n = names[0].strip()
+            inv = invs[n]
+            for item_name, qty in arg:
+                if op == "사용":
+                    if inv.qty(item_name) <= 0:
+                        problems.append(f"⚠️ {no}번째 줄: '{n}'에게 '{item_name}'가 없습니다.")
+                        continue
+                    before, after = inv.remove(item_name, qty)
+                    results.append((no, op, n, item_name, -qty, before, after))
+                else:
+                    before, after = inv.add(item_name, qty)
+                    results.append((no, op, n, item_name, qty, before, after))
+        if problems:
+            return None, problems
+
+        if not SHEET_CAS or (
+            (not hp_found or _cells_unchanged(hp_sh, {f"D{row}": values[2] for row, values in hp_found.values()}))
+            and (not roster_found or _cells_unchanged(roster_sh, {f"F{row}": values[4] for row, values in roster_found.values()}))
+        ):
+            break
+    else:
+        raise ConcurrentEditError("대상 값이 계속 다른 곳에서 수정되고 있어 반영하지 못했습니다. 잠시 후 다시 시도하세요.")
+
+    data = [
+        {"range": gspread.utils.absolute_range_name(hp_sh.title, f"D{hp_found[n][0]}"), "values": [[v]]}
+        for n, v in hp.items()
+    ]
+    raws = {n: inv.to_cell() for n, inv in invs.items()}
+    data += [
+        {"range": gspread.utils.absolute_range_name(roster_sh.title, f"F{roster_found[n][0]}"), "values": [[raw]]}
+        for n, raw in raws.items()
+    ]
+    (hp_sh or roster_sh).spreadsheet.values_batch_update(body={"valueInputOption": "USER_ENTERED", "data": data})
+    for n, raw in raws.items():
+        inventory_cache.store(n, raw, invs[n])
+    return results, None
+
+def _batch_result_line(op: str, name: str, field: str, change: int, before, after) -> str:
+    if op in BATCH_HP_OPS:
+        return f"✅ '{name}' {before} → {change:+d} = **{after}** (D열)"
+    suffix = " (목록에서 제거)" if op == "사용" and after <= 0 else ""
+    return f"✅ '{name}'의 '{field}' {before}개 → {change:+d} = **{after}개**{suffix}"
+
+@bot.command(name="일괄", help="!일괄 (다음 줄부터 한 줄에 하나씩 추가/차감/구매/사용) → 모든 이름을 확인한 뒤 한 번에 반영합니다. 하나라도 실패하면 아무것도 반영하지 않습니다.")
+async def 일괄(ctx, *, 스크립트: str = ""):
+    ops, err = _parse_batch_script(스크립트)
+    if err:
+        await ctx.send(err)
+        return
+
+    try:
+        hp_names, roster_names = _batch_names(ops)
+        ledger = _hp_ledger() if hp_names else None
+        if ledger is not None:
+            await ledger.flush()  # 대기 중 개별 변경을 먼저 반영
+        targets = [(t, names, col) for t, names, col in (("체력값", hp_names, 4), ("명단", roster_names, 6)) if names]
+        results, problems = await sheet_io.write_rows_many(targets, _apply_batch, ops)
+        if ledger is not None:
+            ledger.invalidate()
+        timestamp = now_kst_str()
+        if problems:
+            await ctx.send("⚠️ 아무것도 반영하지 않았습니다.\n" + "\n".join(problems) + f"\n{timestamp}")
+            return
+
+        lines = [f"📦 {len(ops)}줄 일괄 반영 완료"]
+        last_no = None
+        for no, op, name, field, change, before, after in results:
+            _audit(ctx, name, field, before, after)
+            if no != last_no:
+                lines.append(f"**{no}. {op}**")
+                last_no = no
+            lines.append(_batch_result_line(op, name, field, change, before, after))
+        text = "\n".join(lines)
+        if len(text) > 1900:
+            text = text[:1900] + "\n…"
+        await ctx.send(f"{text}\n{timestamp}")
+
+    except Exception as e:
+        await ctx.send(f"❌ 일괄 처리 실패: {e}")
+
 # ====== 도움말: 고정 순서/설명으로 보기 좋게 출력 ======
 
 # 기본 help 제거 (중복 방지)
@@ -483,21 +2393,25 @@ bot.remove_command("help")
 HELP_OVERRIDES = {
     "도움말":  "현재 사용 가능한 명령어 목록을 표시합니다.",
     "시트테스트":    "연결 확인 시트의 A1에 현재 시간을 기록하고 값을 확인합니다. 예) !시트테스트",
-    "추첨":    "체력값 시트 B6부터 마지막 행까지 이름 중에서 숫자만큼 무작위 추첨합니다. 예) !추첨 3",
+    "추첨":    "체력값 시트 B6부터 마지막 행까지 이름 중에서 숫자만큼 무작위 추첨합니다. 열 문자를 덧붙이면 그 열의 숫자(체력값, 응모권 등)를 가중치로 씁니다. 예) !추첨 3, !추첨 3 D",
     "랜덤":    "쉼표 제외 입력한 이름 중 하나를 무작위로 출력합니다. 예) !랜덤 김철수 신짱구 훈이",
-    "합계":   "체력값 시트의 대선(G2), 사련(I2) 값을 불러옵니다. 예) !합계",
-    "구매":   "명단 시트에서 B열의 이름을 찾아 같은 행 F열 물품목록에 아이템을 추가(콤마 누적)합니다. 예) !구매 홍길동 붕대",
-    "사용":   "명단 시트에서 B열의 이름을 찾아 같은 행 F열에서 해당 아이템 1개를 제거합니다. 예) !사용 홍길동 붕대",
+    "합계":   "체력값 시트의 대선(G2), 사련(I2) 값을 불러옵니다. `!합계 최신`은 캐시 없이 바로 읽습니다. 예) !합계",
+    "구매":   "명단 시트에서 B열의 이름을 찾아 같은 행 F열 물품목록에 아이템을 추가(콤마 누적)합니다. 쉼표로 여러 개를 한 번에 넣을 수 있습니다. 예) !구매 홍길동 붕대, 에너지바 2개",
+    "사용":   "명단 시트에서 B열의 이름을 찾아 같은 행 F열에서 해당 아이템 1개를 제거합니다. 쉼표로 여러 개를 한 번에 쓸 수 있습니다. 예) !사용 홍길동 붕대",
     "전체":   "!전체 +수치 / -수치 → 체력값 시트 D6부터 마지막 데이터 행까지 숫자 셀에 수치만큼 일괄 증감합니다. 예) !전체 +5, !전체 -3",
     "추가":   "체력값 시트에서 B열의 이름을 찾아 같은 행 D열(체력값)에 수치만큼 더합니다. 예) !추가 홍길동 5",
     "차감":   "체력값 시트에서 B열의 이름을 찾아 같은 행 D열(체력값)에서 수치만큼 뺍니다. 예) !차감 홍길동 5",
+    "일괄":   "다음 줄부터 한 줄에 하나씩 추가/차감/구매/사용을 적으면 이름을 모두 확인한 뒤 한 번에 반영합니다. 없는 이름이 있으면 아무것도 바뀌지 않습니다. 예) !일괄 (줄바꿈) 추가 홍길동 5 (줄바꿈) 구매 김철수 붕대 2개",
     "접속":   "현재 봇이 정상 작동 중인지 확인합니다.",
     "다이스":    "다이스를 굴려 1에서 10까지의 결괏값을 출력합니다. 예) !다이스",
-    "전투":    "전투에 참여하는 플레이어 이름을 입력하여 전투를 진행합니다. 예) !전투 이름1 이름2"
+    "전투":    "전투에 참여하는 플레이어 이름을 입력하여 전투를 진행합니다. 예) !전투 이름1 이름2",
+    "전투확률": "현재 전투 규칙으로 대량 모의전을 돌려 선공/후공 승률과 라운드 분포를 보여줍니다. 예) !전투확률 50",
+    "프로파일": "(관리자) 지정한 초 동안 샘플링 프로파일러를 켜고 flamegraph 용 파일을 올립니다. 예) !프로파일 10",
+    "느린명령": "(관리자) 기준 시간을 넘긴 최근 명령의 구간별(시트 요청, 디스코드 전송 등) 소요 시간을 보여줍니다. 예) !느린명령 3"
 }
 
 # 표기 순서 고정
-HELP_ORDER = ["도움말", "시트테스트", "추첨", "랜덤", "합계", "구매", "사용", "전체", "추가", "차감", "접속", "다이스", "전투"]
+HELP_ORDER = ["도움말", "시트테스트", "추첨", "랜덤", "합계", "구매", "사용", "전체", "추가", "차감", "일괄", "접속", "다이스", "전투", "전투확률", "프로파일", "느린명령"]
 
 @bot.command(name="도움말")
 async def 도움말(ctx):
@@ -520,6 +2434,73 @@ async def 도움말(ctx):
 
     await ctx.send(f"\n".join(lines))
 
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", "5000"))  # 이보다 긴 명단은 나눠 쓰고 진행 상황 표시
+INT_CELL_RE = re.compile(r"[+-]?\d+")
+
+def _shift_int_cells(rows, delta: int):
+    """
+    [[값], ...] 에서 정수 셀만 delta 만큼 더한 새 목록을 만든다. 빈칸/문자는 그대로.
+    반환: (new_rows, changed)
+    """
+    vals = [(r[0] if r else "").strip() for r in rows]
+    is_int = [INT_CELL_RE.fullmatch(v) is not None for v in vals]
+    new_rows = [[int(v) + delta] if ok else [v] for v, ok in zip(vals, is_int)]
+    return new_rows, sum(is_int)
+
+class PartialBulkError(RuntimeError):
+    """나눠 쓰던 중 실패 — 앞쪽 일부 행(D6~D{last_row})은 이미 반영됨."""
+
+    def __init__(self, last_row: int, changed: int, cause: Exception):
+        super().__init__(str(cause))
+        self.last_row = last_row
+        self.changed = changed
+        self.cause = cause
+
+def _bulk_adjust_hp(delta: int, modifier: str, progress=None):
+    """
+    체력값 D6~마지막 행의 숫자 셀에 delta 일괄 반영 후 D2에 수정자 기록.
+    읽기 1번(D6:D), 쓰기는 값과 D2 를 묶은 batch_update 1번. BULK_CHUNK_ROWS 를 넘으면 나눠 쓰며 progress(완료, 전체) 호출.
+    반환: 변경된 셀 수 / D6 이후 데이터가 없으면 None
+    """
+    sh = ws("체력값")
+    rows = sh.get("D6:D")
+    if not rows:
+        return None
+
+    new_rows, changed = _shift_int_cells(rows, delta)
+    total = len(new_rows)
+    for start in range(0, total, BULK_CHUNK_ROWS):
+        part = new_rows[start:start + BULK_CHUNK_ROWS]
+        top = 6 + start
+        data = [{"range": f"D{top}:D{top + len(part) - 1}", "values": part}]
+        if start + len(part) >= total:
+            data.append({"range": "D2", "values": [[modifier]]})  # 최종 수정자 닉네임 기록 (D2)
+        try:
+            sh.batch_update(data, value_input_option="USER_ENTERED")
+        except Exception as e:
+            if start == 0:
+                raise  # 아무것도 반영되지 않음
+            applied = sum(isinstance(r[0], int) for r in new_rows[:start])
+            raise PartialBulkError(6 + start - 1, applied, e) from e
+        if progress is not None:
+            progress(start + len(part), total)
+    return changed
+
+async def _report_progress(ctx, state: dict, label: str, every: float = 1.5):
+    """state["progress"] = (완료, 전체) 가 바뀔 때마다 메시지 하나를 보내거나 고친다. 작업이 끝나면 cancel."""
+    msg, shown = None, None
+    while True:
+        await asyncio.sleep(every)
+        cur = state.get("progress")
+        if not cur or cur == shown or cur[0] >= cur[1]:
+            continue
+        text = f"⏳ {label} 진행 중... {cur[0]}/{cur[1]}행"
+        if msg is None:
+            msg = await ctx.send(text)
+        else:
+            await msg.edit(content=text)
+        shown = cur
+
 @bot.command(
     name="전체",
     help="!전체 +수치 / -수치 → 체력값 시트 D6부터 마지막 데이터 행까지 숫자 셀에 수치만큼 일괄 증감합니다. 예) !전체 +5, !전체 -3"
@@ -536,36 +2517,25 @@ async def 전체(ctx, 수치: str):
         return
 
     try:
-        sh = ws("체력값")
-
-        # 마지막 행 계산 (D열에서)
-        col_d = sh.col_values(4)  # D열 전체 값
-        last_row = len(col_d)
-        if last_row < 6:
+        ledger = _hp_ledger()
+        with bulk_lane():
+            if ledger is not None:
+                await ledger.flush()  # 대기 중 개별 변경을 먼저 반영
+            state = {}
+            reporter = asyncio.create_task(_report_progress(ctx, state, "전체 체력값 적용"))
+            try:
+                changed = await sheet_io.write(
+                    "체력값", _bulk_adjust_hp, delta, ctx.author.display_name,
+                    progress=lambda done, total: state.__setitem__("progress", (done, total)),
+                )
+            finally:
+                reporter.cancel()
+        if ledger is not None:
+            ledger.invalidate()
+        if changed is None:
             await ctx.send(f"⚠️ D6 이후 데이터가 없습니다.")
             return
-
-        rng = f"D6:D{last_row}"
-        rows = sh.get(rng)
-        new_rows, changed = [], 0
-
-        for r in rows:
-            raw = (r[0] if r else "").strip()
-            if raw == "":
-                new_rows.append([raw])  # 빈칸 유지
-                continue
-            try:
-                cur = int(raw)
-                new_rows.append([cur + delta])
-                changed += 1
-            except ValueError:
-                new_rows.append([raw])  # 숫자 아님 → 유지
-
-        # 시트 업데이트
-        sh.update(rng, new_rows, value_input_option="USER_ENTERED")
-
-        # 최종 수정자 닉네임 기록 (D2)
-        sh.update_acell("D2", ctx.author.display_name)
+        _audit(ctx, "전체", "체력값", None, f"{delta:+d} ({changed}칸)")  # 행마다가 아니라 한 건으로
 
         # 결과 메시지 + 타임스탬프
         sign = "+" if delta >= 0 else ""
@@ -574,286 +2544,272 @@ async def 전체(ctx, 수치: str):
             f"✅ 전체 체력값에 적용 완료했습니다.\n{timestamp}"
         )
 
+    except PartialBulkError as e:
+        if ledger is not None:
+            ledger.invalidate()
+        # 다시 실행하면 앞부분이 두 번 반영되므로, 어디까지 들어갔는지 남기고 알린다
+        _audit(ctx, "전체", "체력값", None, f"{delta:+d} (D6~D{e.last_row} 만 반영, {e.changed}칸)")
+        await ctx.send(
+            f"⚠️ 전체 체력값 적용이 중간에 실패했습니다: {e}\n"
+            f"D6~D{e.last_row} 행({e.changed}칸)에는 이미 {delta:+d} 반영, D{e.last_row + 1} 부터는 반영되지 않았습니다.\n"
+            f"다시 `!전체` 를 실행하면 앞부분이 두 번 반영되니 나머지 행만 따로 고쳐 주세요.\n{now_kst_str()}"
+        )
     except Exception as e:
         await ctx.send(f"❌ 일괄 증감 실패: {e}")
 
 
 # ✅ 전투 기능 시작
-active_battles = {}
+# 진행 중 전투는 메모리(active_battles)에 두고, 상태가 바뀔 때마다 로컬 SQLite 에도 저장한다.
+# 재시작 시 저장된 전투를 다시 읽고, 버튼은 채널 ID 를 담은 custom_id 의 영구 View 로 다시 연결.
+# 다중 워커 모드에서는 이 SQLite 를 워커들이 함께 쓰고, 채널마다 "battle:{채널}" 임대를 잡은 워커 하나만
+# 그 채널의 전투를 진행한다. 임대를 얻은 워커는 메모리 대신 저장된 최신 상태에서 이어 간다.
+BATTLE_STORE_PATH = os.getenv("BATTLE_STORE_PATH", "battles.sqlite3")
+
+class BattleStore:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS battles (channel_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated_at TEXT NOT NULL)"
+        )
+
+    def save(self, channel_id: int, data: dict):
+        state = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        self._db.execute(
+            "INSERT OR REPLACE INTO battles (channel_id, state, updated_at) VALUES (?, ?, ?)",
+            (channel_id, state, now_kst_str()),
+        )
+
+    def delete(self, channel_id: int):
+        self._db.execute("DELETE FROM battles WHERE channel_id = ?", (channel_id,))
+
+    def load(self, channel_id: int) -> dict | None:
+        row = self._db.execute("SELECT state FROM battles WHERE channel_id = ?", (channel_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_all(self) -> dict:
+        return {cid: json.loads(state) for cid, state in self._db.execute("SELECT channel_id, state FROM battles")}
+
+battle_store = BattleStore(BATTLE_STORE_PATH)
+active_battles = {cid: BattleState.from_dict(d) for cid, d in battle_store.load_all().items()}
+
+def _save_battle(channel_id: int):
+    battle_store.save(channel_id, active_battles[channel_id].to_dict())
+
+def _end_battle(channel_id: int):
+    active_battles.pop(channel_id, None)
+    battle_store.delete(channel_id)
+    if shared_leases is not None:
+        shared_leases.release([f"battle:{channel_id}"])
+
+BATTLE_LEASE_TTL = float(os.getenv("BATTLE_LEASE_TTL", "300"))  # 마지막 조작 후 이 시간이 지나면 다른 워커가 넘겨받을 수 있음
+BATTLE_BUSY_MSG = "다른 워커가 이 채널의 전투를 처리 중입니다. 잠시 후 다시 눌러 주세요."
+
+async def _claim_battle(channel_id: int) -> bool:
+    """이 채널 전투를 이 워커가 맡는다. 다른 워커가 맡고 있으면 False. 단일 프로세스면 항상 True."""
+    if shared_leases is None:
+        return True
+    return await asyncio.to_thread(shared_leases.try_acquire, [f"battle:{channel_id}"], BATTLE_LEASE_TTL)
+
+def _current_battle(channel_id: int) -> BattleState | None:
+    if shared_leases is not None:  # 다른 워커가 마지막으로 저장한 상태부터 이어 간다
+        data = battle_store.load(channel_id)
+        if data is None:
+            active_battles.pop(channel_id, None)
+            return None
+        active_battles[channel_id] = BattleState.from_dict(data)
+    return active_battles.get(channel_id)
+
+# 전투판 모드(BATTLE_BOARD=1): 턴마다 새 메시지를 보내지 않고 버튼이 달린 메시지 하나를 고쳐 쓴다. 기본은 턴마다 새 메시지.
+BATTLE_BOARD = os.getenv("BATTLE_BOARD", "0") == "1"
+BATTLE_LOG_LINES = int(os.getenv("BATTLE_LOG_LINES", "8"))  # 전투판에 남길 최근 기록 줄 수
+
+def _push_battle_log(state: BattleState, line: str):
+    state.log.append(line)
+    del state.log[:-BATTLE_LOG_LINES]
+
+def _render_board(state: BattleState, msg: str) -> str:
+    if not state.log:
+        return msg
+    return "📜 최근 기록\n" + "\n".join(state.log) + "\n\n" + msg
+
+async def _post_battle_turn(interaction: discord.Interaction, view, channel_id: int, state: BattleState, msg: str, ongoing: bool):
+    """
+    전투 진행 메시지 출력.
+    - 전투판 모드: 버튼이 달린 메시지를 고쳐 쓰고, 끝나면 버튼을 떼고 View 를 멈춘다.
+    - 기존 모드: 새 메시지(+새 View)를 보내고, 이전 메시지의 버튼은 떼고 View 를 멈춘다.
+    """
+    t0 = time.perf_counter()
+    try:
+        await _send_battle_turn(interaction, view, channel_id, state, msg, ongoing)
+    finally:
+        DISCORD_SEND_LATENCY.observe(time.perf_counter() - t0, "battle")
+
+async def _send_battle_turn(interaction: discord.Interaction, view, channel_id: int, state: BattleState, msg: str, ongoing: bool):
+    if BATTLE_BOARD:
+        content = _render_board(state, msg)
+        new_view = view if ongoing else None
+        if interaction.response.is_done():
+            await interaction.edit_original_response(content=content, view=new_view)
+        else:
+            await interaction.response.edit_message(content=content, view=new_view)
+        if not ongoing and view is not None:
+            view.stop()
+        return
 
-def get_hp_bar(current, max_hp=50, bar_length=10):
+    if view is not None:
+        view.stop()
+    kwargs = {"view": BattleView(channel_id)} if ongoing else {}
+    # 지난 턴 메시지에 멈춘 버튼이 남으면 눌러도 "상호작용 실패" 만 뜨므로 떼어 낸다
+    if interaction.response.is_done():
+        await interaction.followup.send(msg, **kwargs)
+        if interaction.message is not None:
+            await interaction.message.edit(view=None)
+    else:
+        await interaction.channel.send(msg, **kwargs)
+        await interaction.response.edit_message(view=None)
+
+def get_hp_bar(current, max_hp=BATTLE_START_HP, bar_length=10):
     # 체력 바는 current 값 그대로, 음수도 허용
     filled_length = int(bar_length * max(min(current, max_hp), 0) / max_hp)
     bar = '█' * filled_length + '░' * (bar_length - filled_length)
     return f"[{bar}] {current}/{max_hp}"
 
-def decide_winner(hp1_val, hp2_val, p1, p2):
-    # 0 이하면 '0에 더 가까운'(값이 더 큰) 쪽이 승
-    if hp1_val <= 0 and hp2_val > 0:
-        return p2
-    elif hp2_val <= 0 and hp1_val > 0:
-        return p1
-    elif hp1_val <= 0 and hp2_val <= 0:
-        if hp1_val > hp2_val:
-            return p1
-        elif hp2_val > hp1_val:
-            return p2
-        else:
-            return None  # 무승부
+# ===== 전투 이벤트 → 메시지 =====
+# 규칙은 battle.transition 에만 있고, 여기서는 이벤트를 글로 옮기기만 한다.
+def _battle_ts():
+    return datetime.now(KST).strftime("%Y/%m/%d %H:%M:%S")
+
+def _hp_lines(st: BattleState) -> str:
+    return f"{st.p1}: {get_hp_bar(st.hp1)}\n{st.p2}: {get_hp_bar(st.hp2)}\n"
+
+def _end_result(winner) -> str:
+    return f"전투가 종료되었습니다. {winner}의 승리입니다." if winner else "전투가 종료되었습니다. 무승부입니다."
+
+def _defense_result_line(ev: Defended) -> str:
+    # 결과 라인(항상 주사위 내역 포함)
+    dice = (
+        f"공격 **{ev.atk_total}** ( {' + '.join(map(str, ev.atk_rolls))} ) / "
+        f"방어 **{ev.def_total}** ( {' + '.join(map(str, ev.def_rolls))} ) → "
+    )
+    if ev.dmg_to_defender > 0:
+        return dice + f"{ev.defender} 피해 **{ev.dmg_to_defender}**"
+    if ev.dmg_to_attacker > 0:
+        return dice + f"{ev.attacker} **반격 피해 {ev.dmg_to_attacker}**"
+    return dice + "**완전 방어**"
+
+def _render_attack(st: BattleState, ev: Attacked) -> str:
+    return (
+        f"{ev.attacker}의 공격 차례입니다.\n"
+        f"공격 주사위: {' + '.join(map(str, ev.rolls))} = **{ev.total}**\n\n"
+        f"{ev.defender}의 방어 차례입니다.\n\n"
+        f"{_hp_lines(st)}"
+        f"{_battle_ts()}"
+    )
+
+def _render_defense(st: BattleState, ev: Defended, outcome) -> str:
+    head = f"{ev.defender}의 방어 차례입니다.\n{_defense_result_line(ev)}\n"
+    if isinstance(outcome, LastStrike):
+        body = (
+            f"{ev.defender}의 체력이 **0 이하**가 되었지만, 마지막 반격 기회를 얻습니다.\n\n"
+            f"{ev.defender}의 마지막 공격 차례입니다.\n\n"
+        )
+    elif isinstance(outcome, Ended) and outcome.reason == "knockout":
+        body = f"{ev.defender}의 체력이 **0 이하**가 되었습니다.\n\n{_end_result(outcome.winner)}\n"
+    elif isinstance(outcome, Ended):
+        body = f"\n{_end_result(outcome.winner)}\n"
     else:
-        if hp1_val > hp2_val:
-            return p1
-        elif hp2_val > hp1_val:
-            return p2
-        else:
-            return None  # 무승부
+        body = f"\n{outcome.attacker}의 공격 차례입니다.\n\n"
+    return head + body + _hp_lines(st) + _battle_ts()
+
+def _render_forced_end(st: BattleState, ev: Ended) -> str:
+    result = f"{ev.winner}의 승리입니다." if ev.winner else "무승부입니다."
+    return f"전투가 강제로 종료되었습니다.\n\n{_hp_lines(st)}\n{result}\n{_battle_ts()}"
+
+_battle_roll = battle.dice_roller()
 
 class BattleAttackButton(Button):
     def __init__(self, channel_id):
-        super().__init__(label="공격", style=discord.ButtonStyle.danger)
+        super().__init__(label="공격", style=discord.ButtonStyle.danger, custom_id=f"battle:atk:{channel_id}")
         self.channel_id = channel_id
 
     async def callback(self, interaction: discord.Interaction):
-        data = active_battles[self.channel_id]
-        if data["단계"] != "공격":
+        if not await _claim_battle(self.channel_id):
+            await interaction.response.send_message(BATTLE_BUSY_MSG, ephemeral=True)
+            return
+        state = _current_battle(self.channel_id)
+        if not state:
+            await interaction.response.send_message("진행 중인 전투가 없습니다.", ephemeral=True)
+            return
+
+        state, events = battle.transition(state, battle.ATTACK, _battle_roll)
+        ev = events[0]
+        if isinstance(ev, Rejected):
             await interaction.response.send_message("지금은 공격할 수 없습니다.", ephemeral=False)
             return
 
-        attacker = data["턴"]
-        defender = data["상대"]
-
-        # 공격 주사위 4개 (1D6 × 4)
-        atk_rolls = [random.randint(1, 6) for _ in range(5)]
-        atk_sum = sum(atk_rolls)
-
-        # 라운드 증가 및 이번 공격 정보 고정 저장
-        data["라운드"] = data.get("라운드", 0) + 1
-        data["최근공격"] = {"합": atk_sum, "주사위": atk_rolls, "라운드": data["라운드"]}
-        data["공격자"] = attacker
-        data["방어자"] = defender
-        data["단계"] = "방어"
-
-        hp1 = get_hp_bar(data["체력"][data["플레이어1"]])
-        hp2 = get_hp_bar(data["체력"][data["플레이어2"]])
-        timestamp = datetime.now(KST).strftime("%Y/%m/%d %H:%M:%S")
-
-        msg = (
-            f"{attacker}의 공격 차례입니다.\n"
-            f"공격 주사위: {' + '.join(map(str, atk_rolls))} = **{atk_sum}**\n\n"
-            f"{defender}의 방어 차례입니다.\n\n"
-            f"{data['플레이어1']}: {hp1}\n"
-            f"{data['플레이어2']}: {hp2}\n"
-            f"{timestamp}"
-        )
-        await interaction.channel.send(msg, view=BattleView(self.channel_id))
-        await interaction.response.defer()
+        if state.pending:  # 직전 라운드 결과를 기록으로 넘김
+            _push_battle_log(state, state.pending)
+            state.pending = None
+        active_battles[self.channel_id] = state
+        _save_battle(self.channel_id)
+        await _post_battle_turn(interaction, self.view, self.channel_id, state, _render_attack(state, ev), ongoing=True)
 
 class BattleDefendButton(Button):
     def __init__(self, channel_id):
-        super().__init__(label="방어", style=discord.ButtonStyle.primary)
+        super().__init__(label="방어", style=discord.ButtonStyle.primary, custom_id=f"battle:def:{channel_id}")
         self.channel_id = channel_id
 
     async def callback(self, interaction: discord.Interaction):
-        data = active_battles.get(self.channel_id)
-        if not data:
+        if not await _claim_battle(self.channel_id):
+            await interaction.response.send_message(BATTLE_BUSY_MSG, ephemeral=True)
+            return
+        state = _current_battle(self.channel_id)
+        if not state:
             await interaction.response.send_message("진행 중인 전투가 없습니다.", ephemeral=True)
             return
-        if data["단계"] != "방어":
+
+        state, events = battle.transition(state, battle.DEFEND, _battle_roll)
+        if isinstance(events[0], Rejected):
             await interaction.response.send_message("지금은 방어할 수 없습니다.", ephemeral=True)
             return
 
-        defender = data["방어자"]
-        attacker = data["공격자"]
-        last = data.get("최근공격") or {}
-
-        # 인터랙션 먼저 보류
-        await interaction.response.defer()
-
-        # 공격 정보
-        atk_sum = int(last.get("합", 0))
-        atk_rolls = last.get("주사위", [])
-
-        # 방어 주사위 굴리기 (기본 1개)
-        def_rolls = [random.randint(1, 6) for _ in range(1)]
-
-        # ✅ 후공 첫 방어 시 주사위 1개 추가
-        if defender == data["후공"] and data.get("첫방어", True):
-            def_rolls.append(random.randint(1, 6))
-            data["첫방어"] = False  # 이후부터는 적용 안 함
-
-        def_sum = sum(def_rolls)
-
-        # 피해 계산:
-        # - 공격 > 방어  → defender에게 (공격-방어)
-        # - 방어 > 공격  → attacker에게 (방어-공격)  ← 반격
-        # - 동일        → 피해 없음(완전 방어)
-        dmg_to_defender = 0
-        dmg_to_attacker = 0
-        if atk_sum > def_sum:
-            dmg_to_defender = atk_sum - def_sum
-            data["체력"][defender] -= dmg_to_defender
-        elif def_sum > atk_sum:
-            dmg_to_attacker = def_sum - atk_sum
-            data["체력"][attacker] -= dmg_to_attacker
-
-        # 표시용 값(최신 HP로)
-        p1 = data["플레이어1"]; p2 = data["플레이어2"]
-        hp1_val = data["체력"][p1]; hp2_val = data["체력"][p2]
-        hp1 = get_hp_bar(hp1_val)
-        hp2 = get_hp_bar(hp2_val)
-        timestamp = datetime.now(KST).strftime("%Y/%m/%d %H:%M:%S")
-
-        # 결과 라인(항상 주사위 내역 포함)
-        if dmg_to_defender > 0:
-            result_line = (
-                f"공격 **{atk_sum}** ( {' + '.join(map(str, atk_rolls))} ) / "
-                f"방어 **{def_sum}** ( {' + '.join(map(str, def_rolls))} ) → "
-                f"{defender} 피해 **{dmg_to_defender}**"
-            )
-        elif dmg_to_attacker > 0:
-            result_line = (
-                f"공격 **{atk_sum}** ( {' + '.join(map(str, atk_rolls))} ) / "
-                f"방어 **{def_sum}** ( {' + '.join(map(str, def_rolls))} ) → "
-                f"{attacker} **반격 피해 {dmg_to_attacker}**"
-            )
-        else:
-            result_line = (
-                f"공격 **{atk_sum}** ( {' + '.join(map(str, atk_rolls))} ) / "
-                f"방어 **{def_sum}** ( {' + '.join(map(str, def_rolls))} ) → **완전 방어**"
-            )
-
-        # ===== 종료 판정 시작 =====
-        # A) 방어자가 맞아서 0 이하
-        if dmg_to_defender > 0 and data["체력"][defender] <= 0:
-            # 후공에게만 최종 반격 1회
-            if not data.get("최종반격", False) and defender == data["후공"]:
-                data["최종반격"] = True
-                data["턴"], data["상대"] = defender, attacker
-                data["단계"] = "공격"
-                msg = (
-                    f"{defender}의 방어 차례입니다.\n"
-                    f"{result_line}\n"
-                    f"{defender}의 체력이 **0 이하**가 되었지만, 마지막 반격 기회를 얻습니다.\n\n"
-                    f"{defender}의 마지막 공격 차례입니다.\n\n"
-                    f"{p1}: {hp1}\n"
-                    f"{p2}: {hp2}\n"
-                    f"{timestamp}"
-                )
-                await interaction.followup.send(msg, view=BattleView(self.channel_id))
-                return
-            else:
-                # 즉시 종료: 현재 HP로 승자 판정(공격자 고정 승리 아님!)
-                winner = decide_winner(hp1_val, hp2_val, p1, p2)
-                result = f"전투가 종료되었습니다. {winner}의 승리입니다." if winner else "전투가 종료되었습니다. 무승부입니다."
-                msg = (
-                    f"{defender}의 방어 차례입니다.\n"
-                    f"{result_line}\n"
-                    f"{defender}의 체력이 **0 이하**가 되었습니다.\n\n"
-                    f"{result}\n"
-                    f"{p1}: {hp1}\n"
-                    f"{p2}: {hp2}\n"
-                    f"{timestamp}"
-                )
-                await interaction.followup.send(msg)
-                del active_battles[self.channel_id]
-                return
-
-        # B) 반격으로 공격자가 0 이하
-        if dmg_to_attacker > 0 and data["체력"][attacker] <= 0:
-            winner = decide_winner(hp1_val, hp2_val, p1, p2)
-            result = f"전투가 종료되었습니다. {winner}의 승리입니다." if winner else "전투가 종료되었습니다. 무승부입니다."
-            msg = (
-                f"{defender}의 방어 차례입니다.\n"
-                f"{result_line}\n\n"
-                f"{result}\n"
-                f"{p1}: {hp1}\n"
-                f"{p2}: {hp2}\n"
-                f"{timestamp}"
-            )
-            await interaction.followup.send(msg)
-            del active_battles[self.channel_id]
+        ev, outcome = events
+        msg = _render_defense(state, ev, outcome)
+        # 이번 결과는 메시지에 그대로 보이므로, 기록에는 다음 공격 때 넣는다
+        state.pending = f"R{state.round} {_defense_result_line(ev)}"
+        if isinstance(outcome, Ended):
+            _end_battle(self.channel_id)
+            await _post_battle_turn(interaction, self.view, self.channel_id, state, msg, ongoing=False)
             return
 
-        # C) 최종 반격 흐름에서의 종료 판정(동일 규칙)
-        if data.get("최종반격", False):
-            winner = decide_winner(hp1_val, hp2_val, p1, p2)
-            result = f"전투가 종료되었습니다. {winner}의 승리입니다." if winner else "전투가 종료되었습니다. 무승부입니다."
-            msg = (
-                f"{defender}의 방어 차례입니다.\n"
-                f"{result_line}\n\n"
-                f"{result}\n"
-                f"{p1}: {hp1}\n"
-                f"{p2}: {hp2}\n"
-                f"{timestamp}"
-            )
-            await interaction.followup.send(msg)
-            del active_battles[self.channel_id]
-            return
-        # ===== 종료 판정 끝 =====
-
-        # 일반 턴 전환(방어가 끝났으므로 다음 턴은 defender의 공격)
-        data["턴"], data["상대"] = defender, attacker
-        data["단계"] = "공격"
-
-        msg = (
-            f"{defender}의 방어 차례입니다.\n"
-            f"{result_line}\n\n"
-            f"{defender}의 공격 차례입니다.\n\n"
-            f"{p1}: {hp1}\n"
-            f"{p2}: {hp2}\n"
-            f"{timestamp}"
-        )
-        await interaction.followup.send(msg, view=BattleView(self.channel_id))
+        active_battles[self.channel_id] = state
+        _save_battle(self.channel_id)
+        await _post_battle_turn(interaction, self.view, self.channel_id, state, msg, ongoing=True)
 
 class BattleEndButton(Button):
     def __init__(self, channel_id):
-        super().__init__(label="종료", style=discord.ButtonStyle.secondary)
+        super().__init__(label="종료", style=discord.ButtonStyle.secondary, custom_id=f"battle:end:{channel_id}")
         self.channel_id = channel_id
 
     async def callback(self, interaction: discord.Interaction):
-        data = active_battles.get(self.channel_id)
-        if not data:
+        if not await _claim_battle(self.channel_id):
+            await interaction.response.send_message(BATTLE_BUSY_MSG, ephemeral=True)
+            return
+        state = _current_battle(self.channel_id)
+        if not state:
             await interaction.response.send_message("종료할 전투가 없습니다.", ephemeral=False)
             return
 
-        hp1_val = data["체력"][data["플레이어1"]]
-        hp2_val = data["체력"][data["플레이어2"]]
-        hp1_bar = get_hp_bar(hp1_val)
-        hp2_bar = get_hp_bar(hp2_val)
-        timestamp = datetime.now(KST).strftime("%Y/%m/%d %H:%M:%S")
-
-        # 강제 종료 승패 규칙
-        if hp1_val <= 0 and hp2_val > 0:
-            result = f"{data['플레이어2']}의 승리입니다."
-        elif hp2_val <= 0 and hp1_val > 0:
-            result = f"{data['플레이어1']}의 승리입니다."
-        elif hp1_val <= 0 and hp2_val <= 0:
-            # 둘 다 0 이하 → 0에 가까운 쪽 승리 (값이 더 큰 쪽)
-            if hp1_val > hp2_val:
-                result = f"{data['플레이어1']}의 승리입니다."
-            elif hp2_val > hp1_val:
-                result = f"{data['플레이어2']}의 승리입니다."
-            else:
-                result = "무승부입니다."
-        else:
-            # 둘 다 양수 → 높은 체력 승
-            if hp1_val > hp2_val:
-                result = f"{data['플레이어1']}의 승리입니다."
-            elif hp2_val > hp1_val:
-                result = f"{data['플레이어2']}의 승리입니다."
-            else:
-                result = "무승부입니다."
-
-        msg = (
-            f"전투가 강제로 종료되었습니다.\n\n"
-            f"{data['플레이어1']}: {hp1_bar}\n"
-            f"{data['플레이어2']}: {hp2_bar}\n\n"
-            f"{result}\n"
-            f"{timestamp}"
-        )
-        await interaction.channel.send(msg)
-        await interaction.response.defer()
-        del active_battles[self.channel_id]
+        # 강제 종료 승패 규칙은 decide_winner 와 동일
+        state, (ev,) = battle.transition(state, battle.FORCE_END, _battle_roll)
+        if state.pending:
+            state = state.copy()
+            _push_battle_log(state, state.pending)
+            state.pending = None
+        _end_battle(self.channel_id)
+        await _post_battle_turn(interaction, self.view, self.channel_id, state, _render_forced_end(state, ev), ongoing=False)
 
 class BattleView(View):
     def __init__(self, channel_id):
@@ -866,32 +2822,126 @@ class BattleView(View):
 @bot.command()
 async def 전투(ctx, 플레이어1: str, 플레이어2: str):
     channel_id = ctx.channel.id
-    if channel_id in active_battles:
+    # 진행 중인 전투가 있으면 임대를 건드리지 않는다 (새 전투를 열 때만 맡는다)
+    if _current_battle(channel_id) or not await _claim_battle(channel_id):
         await ctx.send(f"이미 이 채널에서 전투가 진행 중입니다.")
         return
 
-    first = random.choice([플레이어1, 플레이어2])
-    second = 플레이어2 if first == 플레이어1 else 플레이어1
-
-    active_battles[channel_id] = {
-        "플레이어1": 플레이어1,
-        "플레이어2": 플레이어2,
-        "체력": {플레이어1: 50, 플레이어2: 50},
-        "단계": "공격",
-        "턴": first,
-        "상대": second,
-        "최종반격": False,
-        "선공": first,
-        "후공": second,     # 후공 저장
-        "첫방어": True,       # 후공 첫 방어 주사위 +1 플래그
-        "라운드": 0,           # ← 추가
-        "최근공격": None       # ← 명시 초기화
-    }
+    state = BattleState(플레이어1, 플레이어2, first=random.choice([0, 1]))
+    active_battles[channel_id] = state
+    _save_battle(channel_id)
 
+    first = state.name(state.first)
     await ctx.send(
         f"전투를 준비합니다.\n{플레이어1} vs {플레이어2}\n선공: {first}\n\n{first}, 공격을 시작하세요.",
         view=BattleView(channel_id)
     )
+
+# ====== 전투 확률 시뮬레이션 ======
+SIM_DEFAULT_TRIALS = 200_000
+SIM_MAX_TRIALS = 2_000_000
+SIM_CACHE_SIZE = 32
+
+@functools.lru_cache(maxsize=SIM_CACHE_SIZE)
+def _cached_simulation(hp: int, trials: int) -> dict:
+    # 같은 (체력, 횟수) 는 다시 굴리지 않고 이전 결과를 보여준다
+    return battle.simulate(trials, hp)
+
+@bot.command(name="전투확률", help="!전투확률 [시작체력] [횟수] → 현재 전투 규칙으로 대량 모의전을 돌려 선공/후공 승률과 라운드 분포를 보여줍니다. 예) !전투확률 50")
+async def 전투확률(ctx, 체력: str = str(BATTLE_START_HP), 횟수: str = str(SIM_DEFAULT_TRIALS)):
+    if not 체력.isdigit() or int(체력) <= 0:
+        await ctx.send(f"⚠️ 시작 체력은 1 이상의 정수여야 합니다. 예) `!전투확률 50`")
+        return
+    if not 횟수.isdigit() or not (1 <= int(횟수) <= SIM_MAX_TRIALS):
+        await ctx.send(f"⚠️ 횟수는 1 ~ {SIM_MAX_TRIALS:,} 사이 정수여야 합니다. 예) `!전투확률 50 100000`")
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(None, _cached_simulation, int(체력), int(횟수))
+        timestamp = now_kst_str()
+        await ctx.send(f"{battle.format_report(report)}\n{timestamp}")
+    except Exception as e:
+        await ctx.send(f"❌ 시뮬레이션 실패: {e}")
 # ✅ 전투 기능 끝
 
-bot.run(DISCORD_TOKEN)
+# ====== 관리자 진단 명령: !프로파일 / !느린명령 ======
+def _is_admin(ctx) -> bool:
+    perms = getattr(ctx.author, "guild_permissions", None)
+    return bool(perms and perms.administrator)
+
+IDLE_FRAME_FILES = ("selectors.py", "threading.py", "thread.py", "queue.py")  # 이벤트 루프/스레드 풀이 놀고 있는 자리
+
+def _top_frames(stacks, limit: int = 8) -> list[tuple[str, int]]:
+    """collapsed stack 에서 맨 끝(실제로 실행 중이던) 프레임별 샘플 수. 대기 중인 프레임은 하나로 묶는다."""
+    leaf = collections.Counter()
+    for stack, n in stacks.items():
+        frame = stack.rsplit(";", 1)[-1]
+        if frame.split("@", 1)[-1].split(":", 1)[0] in IDLE_FRAME_FILES:
+            frame = "(대기)"
+        leaf[frame] += n
+    return leaf.most_common(limit)
+
+@bot.command(name="프로파일", help="(관리자) !프로파일 [초] → 지정한 시간 동안 샘플링 프로파일러를 켜고 flamegraph 용 collapsed stack 파일을 올립니다. 예) !프로파일 10")
+async def 프로파일(ctx, 초: str = "10"):
+    if not _is_admin(ctx):
+        await ctx.send("⛔ 서버 관리자만 사용할 수 있습니다.")
+        return
+    if not 초.isdigit() or not (1 <= int(초) <= PROFILE_MAX_SECONDS):
+        await ctx.send(f"⚠️ 시간은 1 ~ {PROFILE_MAX_SECONDS} 사이 정수(초)여야 합니다. 예) `!프로파일 10`")
+        return
+    if sampling_profiler.running:
+        await ctx.send("⚠️ 이미 프로파일링 중입니다.")
+        return
+
+    try:
+        await ctx.send(f"🔬 {초}초 동안 프로파일링합니다...")
+        loop = asyncio.get_running_loop()
+        stacks, samples = await loop.run_in_executor(None, sampling_profiler.run, int(초))
+        folded = profiler.SamplingProfiler.collapsed(stacks)
+        filename = f"profile-{datetime.now(KST).strftime('%Y%m%d-%H%M%S')}.folded"
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+            f.write(folded)
+        total = sum(stacks.values()) or 1
+        lines = [f"🔬 프로파일 완료: 샘플 {samples}회 / 스택 {len(stacks)}종 (`{filename}`)"]
+        for frame, n in _top_frames(stacks):
+            lines.append(f"- {frame}: {n / total:.1%}")
+        await ctx.send("\n".join(lines), file=discord.File(io.BytesIO(folded.encode("utf-8")), filename=filename))
+    except Exception as e:
+        await ctx.send(f"❌ 프로파일링 실패: {e}")
+
+@bot.command(name="느린명령", help="(관리자) !느린명령 [개수] → 기준 시간을 넘긴 최근 명령의 구간별 소요 시간을 보여줍니다. 예) !느린명령 3")
+async def 느린명령(ctx, 개수: str = "5"):
+    if not _is_admin(ctx):
+        await ctx.send("⛔ 서버 관리자만 사용할 수 있습니다.")
+        return
+    n = int(개수) if 개수.isdigit() and int(개수) > 0 else 5
+    items = slow_commands.recent(n)
+    if not items:
+        await ctx.send(f"✅ {SLOW_COMMAND_SECONDS:g}초를 넘긴 명령이 없습니다.")
+        return
+
+    blocks = []
+    for it in items:
+        at = datetime.fromtimestamp(it.at, KST).strftime("%m-%d %H:%M:%S")
+        lines = [f"🐢 **{it.command}** {it.elapsed:.2f}s ({it.status}) · {at}", f"`{it.args}`"]
+        for name, count, total in it.totals[:8]:
+            lines.append(f"- {name} ×{count}: {total * 1000:.0f}ms")
+        if it.dropped:
+            lines.append(f"- (구간 {it.dropped}개 생략)")
+        blocks.append("\n".join(lines))
+    text = "\n\n".join(blocks)
+    await ctx.send(text if len(text) <= 1900 else text[:1900] + "\n…")
+
+def _on_sigterm(signum, frame):
+    """
+    감독 프로세스/배포가 보내는 SIGTERM: Ctrl+C 처럼 봇을 정상 종료한다.
+    임대는 여기서 풀지 않는다 — 메인 스레드가 SharedLeases 잠금을 쥔 채 끼어들면 교착하므로 atexit 에 맡긴다.
+    """
+    raise KeyboardInterrupt
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    _start_health_server()
+    bot.run(DISCORD_TOKEN)
@@ -0,0 +1,153 @@
+# 🔬 운영 중 진단 도구: 샘플링 프로파일러 + 느린 명령 기록기
+# - SamplingProfiler: 몇 초 동안만 모든 스레드의 스택을 주기적으로 찍어 collapsed stack(flamegraph.pl / speedscope 입력) 으로 만든다.
+# - span()/Trace: 명령 하나 안에서 시트 요청·디스코드 전송·파싱 등에 쓴 시간을 구간별로 모은다.
+# - SlowCommandLog: 기준 시간을 넘긴 명령의 구간 기록만 고정 크기 링 버퍼에 남긴다.
+import collections
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+
+# ====== 샘플링 프로파일러 ======
+class SamplingProfiler:
+    """sys._current_frames() 로 interval 마다 스택을 샘플링. 한 번에 하나만 실행된다."""
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        # collapsed 형식은 ';' 로 프레임을, 마지막 공백으로 개수를 나누므로 둘 다 쓰지 않는다
+        return f"{code.co_name}@{os.path.basename(code.co_filename)}:{frame.f_lineno}".replace(";", ":").replace(" ", "_")
+
+    def _stack(self, thread_name: str, frame) -> str:
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._frame_label(frame))
+            frame = frame.f_back
+        labels.append(thread_name.replace(";", ":").replace(" ", "_"))
+        return ";".join(reversed(labels))
+
+    def run(self, seconds: float) -> tuple[collections.Counter, int]:
+        """seconds 동안 샘플링해서 (collapsed stack 카운터, 샘플 횟수) 반환. 블로킹 → 스레드에서 부를 것."""
+        with self._lock:
+            if self._running:
+                raise RuntimeError("이미 프로파일링 중입니다.")
+            self._running = True
+        stacks = collections.Counter()
+        samples = 0
+        me = threading.get_ident()
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stacks[self._stack(names.get(ident, f"thread-{ident}"), frame)] += 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            self._running = False
+        return stacks, samples
+
+    @staticmethod
+    def collapsed(stacks: collections.Counter) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+# ====== 구간 기록 ======
+class Trace:
+    """명령 한 번의 구간 기록. 시트 I/O 스레드에서도 함께 쓰므로 락으로 보호한다."""
+
+    def __init__(self, name: str, max_spans: int = 200):
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.spans = []  # (시작 오프셋, 이름, 소요 시간)
+        self.dropped = 0
+        self._max = max_spans
+        self._lock = threading.Lock()
+
+    def add(self, name: str, t0: float, elapsed: float):
+        with self._lock:
+            if len(self.spans) < self._max:
+                self.spans.append((t0 - self.started, name, elapsed))
+            else:
+                self.dropped += 1
+
+    def totals(self) -> list[tuple[str, int, float]]:
+        """구간 이름별 (이름, 횟수, 합계 시간), 오래 걸린 순."""
+        agg = {}
+        with self._lock:
+            for _, name, elapsed in self.spans:
+                n, total = agg.get(name, (0, 0.0))
+                agg[name] = (n + 1, total + elapsed)
+        return sorted(((k, n, t) for k, (n, t) in agg.items()), key=lambda x: -x[2])
+
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+
+@contextlib.contextmanager
+def span(name: str):
+    """현재 명령의 Trace 에 구간을 남긴다. 추적 중이 아니면 아무것도 하지 않음."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, t0, time.perf_counter() - t0)
+
+def mark(name: str, t0: float):
+    """t0(perf_counter) 부터 지금까지를 구간으로 남긴다. async with 처럼 span() 으로 감싸기 힘든 대기용."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, t0, time.perf_counter() - t0)
+
+class SlowCommand:
+    __slots__ = ("command", "args", "elapsed", "status", "at", "spans", "totals", "dropped")
+
+    def __init__(self, trace: Trace, args: str, elapsed: float, status: str):
+        self.command = trace.name
+        self.args = args
+        self.elapsed = elapsed
+        self.status = status
+        self.at = trace.started_wall
+        self.spans = list(trace.spans)
+        self.totals = trace.totals()
+        self.dropped = trace.dropped
+
+class SlowCommandLog:
+    """threshold 초를 넘긴 명령만 최근 size 개까지 보관하는 링 버퍼."""
+
+    def __init__(self, threshold: float, size: int = 50):
+        self.threshold = threshold
+        self._items = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, trace: Trace, args: str, elapsed: float, status: str) -> bool:
+        if elapsed < self.threshold:
+            return False
+        with self._lock:
+            self._items.append(SlowCommand(trace, args, elapsed, status))
+        return True
+
+    def recent(self, n: int | None = None) -> list[SlowCommand]:
+        with self._lock:
+            items = list(self._items)
+        items.reverse()
+        return items if n is None else items[:n]
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,75 @@
+# 🔗 여러 워커 프로세스가 함께 쓰는 임대(lease) 저장소 (로컬 SQLite, WAL)
+# 같은 호스트의 워커들이 같은 파일을 열어 "이 이름은 지금 누가 잡고 있다" 를 공유한다.
+# - 행/시트 쓰기 락, 채널별 전투 소유권 등에 쓴다
+# - 임대는 ttl 이 지나면 저절로 풀리므로 워커가 죽어도 영원히 막히지 않는다 (잡고 있는 동안은 renew)
+import sqlite3
+import threading
+import time
+
+class SharedLeases:
+    def __init__(self, path: str, owner: str, ttl: float = 30.0):
+        self.owner = owner
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def try_acquire(self, names, ttl: float | None = None, block_names=(), block_prefixes=()) -> bool:
+        """
+        names 를 모두 잡거나 하나도 잡지 않는다. 이미 내가 잡은 이름은 만료만 늘린다.
+        block_names / block_prefixes 에 걸리는 이름을 다른 워커가 잡고 있으면 실패.
+        """
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        names = list(names)
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for name in list(names) + list(block_names):
+                    row = db.execute(
+                        "SELECT 1 FROM leases WHERE name = ? AND owner != ? AND expires > ?", (name, self.owner, now)
+                    ).fetchone()
+                    if row:
+                        db.execute("ROLLBACK")
+                        return False
+                for prefix in block_prefixes:
+                    row = db.execute(
+                        "SELECT 1 FROM leases WHERE substr(name, 1, ?) = ? AND owner != ? AND expires > ? LIMIT 1",
+                        (len(prefix), prefix, self.owner, now),
+                    ).fetchone()
+                    if row:
+                        db.execute("ROLLBACK")
+                        return False
+                db.executemany(
+                    "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+                    [(n, self.owner, expires) for n in names],
+                )
+                db.execute("COMMIT")
+                return True
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def renew(self, names, ttl: float | None = None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._db.executemany(
+                "UPDATE leases SET expires = ? WHERE name = ? AND owner = ?",
+                [(expires, n, self.owner) for n in names],
+            )
+
+    def release(self, names):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", [(n, self.owner) for n in names]
+            )
+
+    def release_all(self):
+        with self._lock:
+            self._db.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))